@@ -1,4 +1,4 @@
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, request, render_template_string, jsonify, Response
 import os
 import subprocess
 import threading
@@ -6,21 +6,48 @@ import queue
 import time
 from datetime import datetime
 import re
+import shutil
+import filecmp
+import bisect
+import json
+import collections
+import itertools
+import codecs
+import sqlite3
+import atexit
+import gzip
+import sys
+import hashlib
+import uuid
+import argparse
+import random
+import signal
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 
 # 版本信息
 APP_VERSION = "1.2.3"
 
-# 全局变量存储下载任务
-download_queue = queue.Queue()
+# 全局变量存储下载任务（下载队列download_queue见PriorityTaskQueue）
 download_status = {}
 download_history = []
+download_lock = threading.RLock()
 
 # 默认下载目录
 DEFAULT_WORK_DIR = os.path.expanduser("~/Downloads/BBDown-Web")
 
+# 数据目录，保存任务数据库等持久化文件
+DATA_DIR = os.path.expanduser(os.environ.get('BBDOWN_WEB_DATA_DIR', '~/.config/bbdown-web'))
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -176,6 +203,15 @@ HTML_TEMPLATE = """
         .status-failed {
             border-left: 4px solid #f56565;
         }
+        .status-paused {
+            border-left: 4px solid #ecc94b;
+        }
+        .status-cancelled {
+            border-left: 4px solid #a0aec0;
+        }
+        .status-retry_wait {
+            border-left: 4px solid #ed8936;
+        }
         .progress-bar {
             width: 100%;
             height: 20px;
@@ -189,6 +225,50 @@ HTML_TEMPLATE = """
             background: #48bb78;
             transition: width 0.3s;
         }
+        .stage-timeline {
+            display: none;
+            margin-bottom: 15px;
+            font-size: 12px;
+        }
+        .stage-row {
+            display: flex;
+            align-items: center;
+            gap: 8px;
+            margin: 3px 0;
+        }
+        .stage-label {
+            width: 120px;
+            color: #4a5568;
+            text-align: right;
+            white-space: nowrap;
+        }
+        .stage-track {
+            flex: 1;
+            position: relative;
+            height: 10px;
+            background: #edf2f7;
+            border-radius: 5px;
+        }
+        .stage-bar {
+            position: absolute;
+            top: 0;
+            height: 100%;
+            border-radius: 5px;
+            background: #667eea;
+        }
+        .stage-queue { background: #a0aec0; }
+        .stage-startup { background: #cbd5e0; }
+        .stage-info { background: #38b2ac; }
+        .stage-video { background: #4299e1; }
+        .stage-audio { background: #48bb78; }
+        .stage-extras { background: #ecc94b; }
+        .stage-mux { background: #ed8936; }
+        .stage-finalize { background: #9f7aea; }
+        .stage-running { opacity: 0.6; }
+        .stage-time {
+            width: 60px;
+            color: #718096;
+        }
         .log-output {
             background: #1a202c;
             color: #a0aec0;
@@ -519,8 +599,13 @@ HTML_TEMPLATE = """
                         <label>视频地址或ID (支持av/bv/ep/ss):</label>
                         <input type="text" id="url" name="url" 
                                placeholder="支持直接粘贴分享文本，如：【标题】 https://b23.tv/xxx 或 BV1qt4y1X7TW" required>
+                        <textarea id="batch-urls" name="urls" style="display: none; min-height: 150px;"
+                                  placeholder="每行一个或直接粘贴包含多个链接的文本，自动识别并去重"></textarea>
                         <div class="help-text">
                             支持格式：BV号、av号、完整链接、短链接、分享文本等
+                            <label style="display: inline; font-weight: normal; margin-left: 10px;">
+                                <input type="checkbox" id="batch-mode" onchange="toggleBatchMode()"> 批量模式
+                            </label>
                         </div>
                     </div>
 
@@ -564,6 +649,7 @@ HTML_TEMPLATE = """
                         <label><input type="checkbox" name="video_only"> 仅下载视频</label>
                         <label><input type="checkbox" name="audio_only"> 仅下载音频</label>
                         <label><input type="checkbox" name="use_aria2"> 使用Aria2加速</label>
+                        <label><input type="checkbox" name="force"> 重新下载已有视频</label>
                     </div>
 
                     <span class="toggle-advanced" onclick="toggleAdvanced()">▼ 高级选项</span>
@@ -640,6 +726,15 @@ HTML_TEMPLATE = """
                             </div>
                         </div>
 
+                        <div class="input-group">
+                            <label>任务优先级:</label>
+                            <select id="priority" name="priority">
+                                <option value="0">普通</option>
+                                <option value="10">高（优先下载）</option>
+                                <option value="-10">低</option>
+                            </select>
+                        </div>
+
                         <div class="checkbox-group">
                             <label><input type="checkbox" name="skip_mux"> 跳过混流</label>
                             <label><input type="checkbox" name="force_http"> 强制HTTP</label>
@@ -687,6 +782,18 @@ HTML_TEMPLATE = """
                         <input type="text" id="default_dir" value="~/Downloads/BBDown-Web">
                         <small style="color: #718096;">所有视频将下载到此目录</small>
                     </div>
+                    
+                    <div class="input-group">
+                        <label>同时下载任务数:</label>
+                        <input type="number" id="max_workers" min="1" max="16" value="2">
+                        <small style="color: #718096;">同时运行的BBDown进程数量，每个任务使用独立的临时目录</small>
+                    </div>
+                    
+                    <div class="input-group">
+                        <label>失败自动重试次数:</label>
+                        <input type="number" id="max_retries" min="0" max="10" value="3">
+                        <small style="color: #718096;">网络错误或请求被限流(412)时，等待一段时间后自动重试，等待时间逐次加倍</small>
+                    </div>
                 </div>
 
                 <div class="settings-section">
@@ -742,6 +849,7 @@ HTML_TEMPLATE = """
                 <h3>下载日志</h3>
                 <button type="button" class="info-btn" onclick="clearLog()" style="padding: 6px 12px; font-size: 14px;">清空日志</button>
             </div>
+            <div class="stage-timeline" id="stage-timeline"></div>
             <div class="log-output" id="log-output"></div>
         </div>
     </div>
@@ -770,6 +878,7 @@ HTML_TEMPLATE = """
     <script>
         let currentTaskId = null;
         let logUpdateInterval = null;
+        let logEventSource = null;  // 当前任务的日志事件流
         let currentWorkDir = '~/Downloads/BBDown-Web';
         let activeNewTaskId = null;  // 记录当前活动的新任务ID
         let userIsScrolling = false;  // 标记用户是否正在滚动
@@ -971,24 +1080,39 @@ HTML_TEMPLATE = """
             return input;
         }
 
+        function toggleBatchMode() {
+            const batch = document.getElementById('batch-mode').checked;
+            document.getElementById('url').style.display = batch ? 'none' : 'block';
+            document.getElementById('batch-urls').style.display = batch ? 'block' : 'none';
+        }
+
         async function submitDownload() {
             const form = document.getElementById('download-form');
             const formData = new FormData(form);
             const data = Object.fromEntries(formData.entries());
+            const batchMode = document.getElementById('batch-mode').checked;
             
             // 验证并提取URL
-            if (!data.url || data.url.trim() === '') {
-                showNotification('请输入视频地址', 'warning');
-                return;
+            if (batchMode) {
+                delete data.url;
+                if (!data.urls || data.urls.trim() === '') {
+                    showNotification('请输入视频地址', 'warning');
+                    return;
+                }
+            } else {
+                delete data.urls;
+                if (!data.url || data.url.trim() === '') {
+                    showNotification('请输入视频地址', 'warning');
+                    return;
+                }
+                // 从输入中提取URL
+                data.url = extractUrl(data.url);
             }
             
-            // 从输入中提取URL
-            data.url = extractUrl(data.url);
-            
             // 处理复选框
             const checkboxes = ['download_danmaku', 'download_subtitle', 'download_cover', 
                                'video_only', 'audio_only', 'use_aria2', 
-                               'skip_mux', 'force_http', 'show_all', 'use_mp4box'];
+                               'skip_mux', 'force_http', 'show_all', 'use_mp4box', 'force'];
             checkboxes.forEach(name => {
                 data[name] = document.querySelector(`input[name="${name}"]`).checked;
             });
@@ -1008,6 +1132,11 @@ HTML_TEMPLATE = """
                 data.upos_host = settings.upos_host;
             }
             
+            if (batchMode) {
+                await submitBatchDownload(data);
+                return;
+            }
+            
             try {
                 const response = await fetch('/api/download', {
                     method: 'POST',
@@ -1016,7 +1145,9 @@ HTML_TEMPLATE = """
                 });
                 
                 const result = await response.json();
-                if (result.success) {
+                if (result.success && result.downloaded) {
+                    showNotification(result.message, 'warning');
+                } else if (result.success) {
                     currentTaskId = result.task_id;
                     activeNewTaskId = result.task_id;  // 记录新任务ID
                     autoScrollEnabled = true;  // 新任务默认启用自动滚动
@@ -1024,7 +1155,38 @@ HTML_TEMPLATE = """
                     startLogUpdate(currentTaskId, true);  // 新任务，自动滚动
                     // 切换到状态标签页
                     document.querySelector('.tab:nth-child(2)').click();
-                    showNotification('下载任务已添加到队列', 'success');
+                    showNotification(result.message, result.attached ? 'info' : 'success');
+                } else {
+                    showNotification(result.message, 'error');
+                }
+            } catch (error) {
+                showNotification('请求失败: ' + error, 'error');
+            }
+        }
+
+        async function submitBatchDownload(data) {
+            try {
+                const response = await fetch('/api/download/batch', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify(data)
+                });
+                
+                const result = await response.json();
+                if (result.success) {
+                    // 切换到状态标签页
+                    document.querySelector('.tab:nth-child(2)').click();
+                    let message = `已添加 ${result.count} 个下载任务`;
+                    if (result.duplicates) {
+                        message += `，跳过重复 ${result.duplicates} 个`;
+                    }
+                    if (result.downloaded) {
+                        message += `，跳过已下载 ${result.downloaded} 个`;
+                    }
+                    if (result.attached) {
+                        message += `，${result.attached} 个已在下载中`;
+                    }
+                    showNotification(message, 'success');
                 } else {
                     showNotification(result.message, 'error');
                 }
@@ -1053,14 +1215,25 @@ HTML_TEMPLATE = """
                     })
                 });
                 
-                const data = await response.json();
+                let data = await response.json();
+                if (data.success && data.status === 'running') {
+                    showNotification('正在解析，请稍候...', 'info');
+                }
+                // 解析在后台进行，长轮询直到完成
+                while (data.success && data.status === 'running') {
+                    const poll = await fetch(`/api/parse/${data.job_id}?wait=20`);
+                    data = await poll.json();
+                }
+                
                 if (data.success) {
-                    // 在日志窗口显示解析信息
+                    // 在日志窗口显示解析信息，停止正在显示的任务日志
+                    stopLogUpdate();
+                    currentTaskId = null;
                     document.getElementById('log-card').style.display = 'block';
                     const logOutput = document.getElementById('log-output');
                     // 使用innerHTML显示带颜色的日志
                     logOutput.innerHTML = formatLogHtml(data.info);
-                    showNotification('解析成功', 'success');
+                    showNotification(formatParseSummary(data.video), 'success', '解析成功');
                 } else {
                     showNotification('解析失败: ' + data.message, 'error');
                 }
@@ -1069,6 +1242,20 @@ HTML_TEMPLATE = """
             }
         }
 
+        // 解析结果摘要：标题、分P数和可用画质
+        function formatParseSummary(video) {
+            if (!video) return '解析成功';
+            const lines = [];
+            if (video.title) lines.push(video.title);
+            if (video.pages.length) {
+                const total = video.pages.reduce((sum, page) => sum + page.duration_seconds, 0);
+                lines.push(`共 ${video.pages.length} 个分P，总时长 ${formatDuration(total)}`);
+            }
+            const qualities = [...new Set(video.video_streams.map(stream => stream.quality).filter(Boolean))];
+            if (qualities.length) lines.push(`可用画质: ${qualities.join(', ')}`);
+            return lines.join('<br>') || '解析成功';
+        }
+
         function clearForm() {
             showConfirm('确定要清空表单吗？', '清空表单', () => {
                 document.getElementById('download-form').reset();
@@ -1085,84 +1272,430 @@ HTML_TEMPLATE = """
             document.getElementById('log-card').style.display = 'block';
         }
 
-        function startLogUpdate(taskId, isNewTask = false) {
+        // 渲染日志片段，reset为true时整体替换
+        function renderLogChunk(view, text, reset) {
+            const logOutput = document.getElementById('log-output');
+            if (reset) {
+                logOutput.innerHTML = formatLogHtml(text);
+            } else if (text) {
+                logOutput.insertAdjacentHTML('beforeend', formatLogHtml(text));
+            }
+            
+            // 首次加载时，如果不是新任务，滚动到顶部
+            if (view.firstLoad && !view.isNewTask) {
+                justSwitchedTask = true;  // 标记刚切换任务
+                logOutput.scrollTop = 0;  // 滚动到顶部
+                autoScrollEnabled = false;  // 默认不自动滚动
+                view.firstLoad = false;
+            } else if (view.firstLoad && view.isNewTask) {
+                // 新任务首次加载，滚动到底部
+                logOutput.scrollTop = logOutput.scrollHeight;
+                view.firstLoad = false;
+            } else if (text && autoScrollEnabled && !userIsScrolling) {
+                // 只有在自动滚动启用且用户没有正在滚动时才自动滚动到底部
+                logOutput.scrollTop = logOutput.scrollHeight;
+            }
+        }
+        
+        const STAGE_LABELS = {
+            queue: '排队',
+            startup: '启动BBDown',
+            info: '获取信息',
+            video: '下载视频',
+            audio: '下载音频',
+            extras: '弹幕/字幕/封面',
+            mux: '合并音视频',
+            finalize: '移动文件'
+        };
+        let timelineTimer = null;
+
+        function formatStageSeconds(seconds) {
+            return seconds < 60 ? `${seconds.toFixed(1)}s` : formatDuration(seconds);
+        }
+
+        // 各阶段的瀑布图，进行中的阶段按当前时间计算并每秒刷新
+        function renderTimeline(timeline) {
+            const container = document.getElementById('stage-timeline');
+            clearTimeout(timelineTimer);
+            timelineTimer = null;
+            if (!timeline || !timeline.length) {
+                container.style.display = 'none';
+                container.innerHTML = '';
+                return;
+            }
+            const now = Date.now() / 1000;
+            const begin = timeline[0].start;
+            const stops = timeline.map(stage => stage.end === null ? Math.max(now, stage.start) : stage.end);
+            const total = Math.max(Math.max(...stops) - begin, 0.001);
+            container.style.display = 'block';
+            container.innerHTML = timeline.map((stage, index) => {
+                const duration = stops[index] - stage.start;
+                const left = (stage.start - begin) / total * 100;
+                const width = Math.max(duration / total * 100, 0.5);
+                let label = (STAGE_LABELS[stage.stage] || stage.stage) + (stage.part ? ` P${stage.part}` : '');
+                if (stage.attempt) label += ` (重试${stage.attempt})`;
+                const running = stage.end === null ? ' stage-running' : '';
+                return `<div class="stage-row"><span class="stage-label">${label}</span>` +
+                    `<div class="stage-track"><div class="stage-bar stage-${stage.stage}${running}" style="left: ${left}%; width: ${width}%;"></div></div>` +
+                    `<span class="stage-time">${formatStageSeconds(duration)}</span></div>`;
+            }).join('');
+            if (timeline[timeline.length - 1].end === null) {
+                timelineTimer = setTimeout(() => renderTimeline(timeline), 1000);
+            }
+        }
+        
+        // 处理任务状态变化，返回true表示任务已结束
+        function handleTaskStatus(view, status) {
+            const finished = status === 'completed' || status === 'failed' || status === 'cancelled';
+            // 只有当前任务是新提交的任务，且状态发生变化时才显示通知
+            if (view.taskId === activeNewTaskId && !view.notificationShown && view.lastStatus !== status && finished) {
+                updateStatus();
+                view.notificationShown = true;
+                activeNewTaskId = null;  // 清除活动任务ID
+                
+                if (status === 'completed') {
+                    showNotification('下载任务已完成！', 'success', '下载完成');
+                } else if (status === 'failed') {
+                    showNotification('下载任务失败，请查看日志了解详情', 'error', '下载失败');
+                } else if (status === 'cancelled') {
+                    showNotification('下载任务已取消', 'info');
+                }
+            }
+            view.lastStatus = status;
+            return finished;
+        }
+        
+        function stopLogUpdate() {
             if (logUpdateInterval) {
                 clearInterval(logUpdateInterval);
+                logUpdateInterval = null;
+            }
+            if (logEventSource) {
+                logEventSource.close();
+                logEventSource = null;
+            }
+        }
+        
+        function startLogUpdate(taskId, isNewTask = false) {
+            stopLogUpdate();
+            renderTimeline([]);
+            
+            const view = {
+                taskId: taskId,
+                isNewTask: isNewTask,
+                firstLoad: true,  // 标记是否首次加载
+                notificationShown: false,  // 防止重复通知
+                lastStatus: null  // 记录上一次的状态
+            };
+            
+            if (!window.EventSource) {
+                startLogPolling(view);
+                return;
             }
             
-            let notificationShown = false;  // 防止重复通知
-            let lastStatus = null;  // 记录上一次的状态
-            let firstLoad = true;  // 标记是否首次加载
+            // 服务器推送日志，断线后浏览器会带上Last-Event-ID自动续传
+            const source = new EventSource(`/api/task/${taskId}/stream`);
+            logEventSource = source;
+            source.addEventListener('log', (event) => {
+                const data = JSON.parse(event.data);
+                renderLogChunk(view, data.text, data.reset);
+            });
+            source.addEventListener('stage', (event) => {
+                renderTimeline(JSON.parse(event.data).timeline);
+            });
+            source.addEventListener('status', (event) => {
+                handleTaskStatus(view, JSON.parse(event.data).status);
+            });
+            source.addEventListener('end', () => {
+                source.close();
+                if (logEventSource === source) logEventSource = null;
+            });
+            source.onerror = () => {
+                // 连接被拒绝（如任务不存在）时退回轮询
+                if (source.readyState === EventSource.CLOSED && logEventSource === source) {
+                    logEventSource = null;
+                    startLogPolling(view);
+                }
+            };
+        }
+        
+        function startLogPolling(view) {
+            let logOffset = null;  // 已获取日志的偏移量，首次为null表示获取末尾部分
+            let fetching = false;  // 防止上一次请求未返回时重复请求
+            const taskId = view.taskId;
             
             logUpdateInterval = setInterval(async () => {
+                if (fetching) return;
+                fetching = true;
                 try {
-                    const response = await fetch(`/api/task/${taskId}/log`);
+                    const url = logOffset === null ? `/api/task/${taskId}/log` : `/api/task/${taskId}/log?since=${logOffset}`;
+                    const response = await fetch(url);
                     const data = await response.json();
                     
-                    if (data.log) {
-                        const logOutput = document.getElementById('log-output');
-                        // 使用innerHTML显示带颜色的日志
-                        logOutput.innerHTML = formatLogHtml(data.log);
-                        
-                        // 首次加载时，如果不是新任务，滚动到顶部
-                        if (firstLoad && !isNewTask) {
-                            justSwitchedTask = true;  // 标记刚切换任务
-                            logOutput.scrollTop = 0;  // 滚动到顶部
-                            autoScrollEnabled = false;  // 默认不自动滚动
-                            firstLoad = false;
-                        } else if (firstLoad && isNewTask) {
-                            // 新任务首次加载，滚动到底部
-                            logOutput.scrollTop = logOutput.scrollHeight;
-                            firstLoad = false;
-                        } else if (autoScrollEnabled && !userIsScrolling) {
-                            // 只有在自动滚动启用且用户没有正在滚动时才自动滚动到底部
-                            logOutput.scrollTop = logOutput.scrollHeight;
-                        }
-                    }
+                    // 切换到其他任务后丢弃旧任务的响应
+                    if (taskId !== currentTaskId && currentTaskId !== null) return;
                     
-                    // 只有当前任务是新提交的任务，且状态发生变化时才显示通知
-                    if (taskId === activeNewTaskId && !notificationShown && lastStatus !== data.status) {
-                        if (data.status === 'completed' || data.status === 'failed') {
-                            clearInterval(logUpdateInterval);
-                            updateStatus();
-                            notificationShown = true;
-                            activeNewTaskId = null;  // 清除活动任务ID
-                            
-                            if (data.status === 'completed') {
-                                showNotification('下载任务已完成！', 'success', '下载完成');
-                            } else if (data.status === 'failed') {
-                                showNotification('下载任务失败，请查看日志了解详情', 'error', '下载失败');
-                            }
-                        }
+                    if (data.offset !== undefined) {
+                        renderLogChunk(view, data.log, logOffset === null || data.truncated);
+                        renderTimeline(data.timeline);
+                        logOffset = data.offset;
                     }
                     
-                    lastStatus = data.status;
+                    if (handleTaskStatus(view, data.status) || data.status === 'not_found') {
+                        clearInterval(logUpdateInterval);
+                        logUpdateInterval = null;
+                    }
                 } catch (error) {
                     console.error('获取日志失败:', error);
+                } finally {
+                    fetching = false;
                 }
             }, 1000);
         }
 
-        async function updateStatus() {
+        let statusFeed = null;  // 全局任务事件流
+        const feedTasks = new Map();  // 由事件流维护的任务表，按创建顺序排列
+        let statusRenderPending = false;
+        const TASK_EVENTS = ['task-created', 'task-started', 'task-progress', 'task-updated',
+                             'task-completed', 'task-failed', 'task-cancelled'];
+
+        function formatBytes(bytes) {
+            const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+            let value = bytes;
+            let index = 0;
+            while (value >= 1024 && index < units.length - 1) {
+                value /= 1024;
+                index++;
+            }
+            return `${value.toFixed(index ? 2 : 0)}${units[index]}`;
+        }
+
+        function formatDuration(seconds) {
+            const h = Math.floor(seconds / 3600);
+            const m = Math.floor(seconds % 3600 / 60);
+            const s = Math.floor(seconds % 60);
+            const pad = (n) => String(n).padStart(2, '0');
+            return h ? `${h}:${pad(m)}:${pad(s)}` : `${pad(m)}:${pad(s)}`;
+        }
+
+        // 当前流的已下载大小、速度和剩余时间
+        function formatTransfer(task) {
+            const info = task.transfer && task.transfer[task.stream];
+            if (!info || task.status !== 'downloading') return '';
+            const parts = [task.stream === 'audio' ? '音频' : '视频'];
+            if (info.total) parts.push(`${formatBytes(info.downloaded)}/${formatBytes(info.total)}`);
+            if (info.speed) parts.push(`${formatBytes(info.speed)}/s`);
+            if (info.eta !== undefined) parts.push(`剩余 ${formatDuration(info.eta)}`);
+            return `<small style="color: #718096;">${parts.join(' · ')}</small>`;
+        }
+
+        const FAILURE_LABELS = {
+            rate_limit: '请求被限流(412)',
+            auth: '登录状态或Cookie无效',
+            not_found: '视频不存在或不可见',
+            mux: '混流失败',
+            network: '网络错误',
+            unknown: '未知错误'
+        };
+
+        function formatRetryInfo(task) {
+            if (!task.retries && !task.failure) return '';
+            const parts = [];
+            if (task.failure) parts.push(`原因: ${FAILURE_LABELS[task.failure] || task.failure}`);
+            if (task.retries) parts.push(`已重试 ${task.retries} 次`);
+            if (task.status === 'retry_wait' && task.retry_at) {
+                parts.push(`${new Date(task.retry_at * 1000).toLocaleTimeString()} 重试`);
+            }
+            return `<br><small style="color: #dd6b20;">${parts.join(' · ')}</small>`;
+        }
+
+        // 进程树的CPU时间、内存峰值和磁盘读写量
+        function formatResources(task) {
+            const r = task.resources;
+            if (!r || !r.processes) return '';
+            const parts = [`CPU ${r.cpu_seconds.toFixed(1)}s`, `内存峰值 ${formatBytes(r.peak_rss)}`,
+                           `读 ${formatBytes(r.read_bytes)}`, `写 ${formatBytes(r.write_bytes)}`];
+            return `<br><small style="color: #a0aec0;">${parts.join(' · ')}</small>`;
+        }
+
+        function formatQueueInfo(task) {
+            if (task.queue_position === null || task.queue_position === undefined) return '';
+            const priority = task.priority ? ` | 优先级: ${task.priority}` : '';
+            return ` | 队列位置: ${task.queue_position + 1}${priority}`;
+        }
+
+        async function moveTaskToFront(taskId) {
             try {
-                const response = await fetch('/api/status');
-                const data = await response.json();
-                const statusList = document.getElementById('status-list');
-                
-                if (data.tasks && data.tasks.length > 0) {
-                    statusList.innerHTML = data.tasks.map(task => `
-                        <div class="status-item status-${task.status}">
-                            <div style="flex: 1;">
-                                <strong>${task.title || task.url}</strong>
-                                <br><small>状态: ${task.status} | 开始时间: ${task.start_time}</small>
-                                ${task.progress ? `<div class="progress-bar"><div class="progress-fill" style="width: ${task.progress}%"></div></div>` : ''}
-                            </div>
-                            <button onclick="viewTaskLog('${task.id}')">查看日志</button>
+                const response = await fetch(`/api/task/${taskId}/move-to-front`, {method: 'POST'});
+                const result = await response.json();
+                showNotification(result.message, result.success ? 'success' : 'error');
+                if (!statusFeed) updateStatus();
+            } catch (error) {
+                showNotification('请求失败: ' + error, 'error');
+            }
+        }
+
+        async function controlTask(taskId, action) {
+            try {
+                const response = await fetch(`/api/task/${taskId}/${action}`, {method: 'POST'});
+                const result = await response.json();
+                showNotification(result.message, result.success ? 'success' : 'error');
+                if (!statusFeed) updateStatus();
+            } catch (error) {
+                showNotification('请求失败: ' + error, 'error');
+            }
+        }
+
+        // 队列顺序被调整后重新获取一次排队位置，短时间内的多次调整只请求一次
+        let queueSyncTimer = null;
+        function scheduleQueueSync() {
+            if (queueSyncTimer) return;
+            queueSyncTimer = setTimeout(async () => {
+                queueSyncTimer = null;
+                try {
+                    const {data} = await fetchJSONCached('/api/status');
+                    data.tasks.forEach(update => {
+                        const task = feedTasks.get(update.id);
+                        if (task) {
+                            task.queue_position = update.queue_position;
+                            task.priority = update.priority;
+                        }
+                    });
+                    scheduleStatusRender();
+                } catch (error) {
+                    console.error('同步队列位置失败:', error);
+                }
+            }, 300);
+        }
+
+        function renderStatusList(tasks) {
+            const statusList = document.getElementById('status-list');
+            if (tasks && tasks.length > 0) {
+                statusList.innerHTML = tasks.map(task => `
+                    <div class="status-item status-${task.status}">
+                        <div style="flex: 1;">
+                            <strong>${task.title || task.url}</strong>
+                            <br><small>状态: ${task.status} | 开始时间: ${task.start_time}${task.slot !== null && task.slot !== undefined ? ` | 槽位: #${task.slot + 1}` : ''}${formatQueueInfo(task)}</small>
+                            ${task.progress ? `<div class="progress-bar"><div class="progress-fill" style="width: ${task.progress}%"></div></div>` : ''}
+                            ${formatTransfer(task)}
+                            ${formatRetryInfo(task)}
+                            ${formatResources(task)}
                         </div>
-                    `).join('');
-                } else {
-                    statusList.innerHTML = '<p style="text-align: center; color: #718096;">暂无下载任务</p>';
+                        ${task.queue_position ? `<button class="secondary-btn" onclick="moveTaskToFront('${task.id}')">置顶</button>` : ''}
+                        ${task.status === 'downloading' ? `<button class="secondary-btn" onclick="controlTask('${task.id}', 'pause')">暂停</button>` : ''}
+                        ${task.status === 'paused' ? `<button class="secondary-btn" onclick="controlTask('${task.id}', 'resume')">继续</button>` : ''}
+                        ${['pending', 'downloading', 'paused', 'retry_wait'].includes(task.status) ? `<button class="danger-btn" onclick="controlTask('${task.id}', 'cancel')">取消</button>` : ''}
+                        <button onclick="viewTaskLog('${task.id}')">查看日志</button>
+                    </div>
+                `).join('');
+            } else {
+                statusList.innerHTML = '<p style="text-align: center; color: #718096;">暂无下载任务</p>';
+            }
+        }
+
+        // 合并同一帧内的多次更新，只渲染一次
+        function scheduleStatusRender() {
+            if (statusRenderPending) return;
+            statusRenderPending = true;
+            requestAnimationFrame(() => {
+                statusRenderPending = false;
+                renderStatusList(Array.from(feedTasks.values()).slice(-10).reverse());
+            });
+        }
+
+        let statusPollTimer = null;
+        // 不支持事件流或服务器事件流连接数已满时定期轮询状态
+        function startStatusPolling() {
+            if (statusPollTimer) return;
+            updateStatus();
+            statusPollTimer = setInterval(() => {
+                const statusTab = document.getElementById('status-tab');
+                if (statusTab.classList.contains('active')) {
+                    updateStatus();
+                }
+            }, 5000);
+        }
+
+        function stopStatusPolling() {
+            clearInterval(statusPollTimer);
+            statusPollTimer = null;
+        }
+
+        function connectStatusFeed() {
+            const source = new EventSource('/api/events');
+            statusFeed = source;
+            
+            // 服务器拒绝连接（如事件流已满返回503）时浏览器不会自动重连：先改为轮询，稍后再试
+            source.onerror = () => {
+                if (source.readyState === EventSource.CLOSED && statusFeed === source) {
+                    statusFeed = null;
+                    startStatusPolling();
+                    setTimeout(connectStatusFeed, 60000);
+                }
+            };
+            
+            // 连接（或重连后事件已丢失）时服务器先发送完整快照
+            source.addEventListener('snapshot', (event) => {
+                stopStatusPolling();
+                const data = JSON.parse(event.data);
+                feedTasks.clear();
+                data.tasks.slice().reverse().forEach(task => feedTasks.set(task.id, task));
+                scheduleStatusRender();
+            });
+            
+            const mergeTask = (event) => {
+                const data = JSON.parse(event.data);
+                const task = feedTasks.get(data.id);
+                if (task) {
+                    Object.assign(task, data);
+                } else if (data.url !== undefined) {
+                    feedTasks.set(data.id, data);
+                    if (feedTasks.size > 100) {
+                        feedTasks.delete(feedTasks.keys().next().value);
+                    }
                 }
+                scheduleStatusRender();
+            };
+            TASK_EVENTS.forEach(name => source.addEventListener(name, mergeTask));
+            
+            // 每开始一个任务，排在后面的任务都前进一位
+            source.addEventListener('task-started', () => {
+                feedTasks.forEach(task => {
+                    if (task.queue_position) task.queue_position--;
+                });
+                scheduleStatusRender();
+            });
+            source.addEventListener('queue-changed', scheduleQueueSync);
+        }
+
+        // 带ETag的GET请求：内容未变化时服务器返回304，直接使用上次的结果
+        const jsonCache = new Map();
+        async function fetchJSONCached(url) {
+            const cached = jsonCache.get(url);
+            const response = await fetch(url, {
+                headers: cached ? {'If-None-Match': cached.etag} : {},
+                cache: 'no-store'
+            });
+            if (response.status === 304 && cached) {
+                return {data: cached.data, changed: false};
+            }
+            const data = await response.json();
+            const etag = response.headers.get('ETag');
+            if (etag) {
+                jsonCache.set(url, {etag: etag, data: data});
+            }
+            return {data: data, changed: true};
+        }
+
+        async function updateStatus() {
+            // 事件流已连接时直接使用本地任务表
+            if (statusFeed && statusFeed.readyState === EventSource.OPEN) {
+                scheduleStatusRender();
+                return;
+            }
+            try {
+                const {data, changed} = await fetchJSONCached('/api/status');
+                if (changed) renderStatusList(data.tasks);
             } catch (error) {
                 console.error('更新状态失败:', error);
             }
@@ -1170,8 +1703,8 @@ HTML_TEMPLATE = """
 
         async function updateHistory() {
             try {
-                const response = await fetch('/api/history');
-                const data = await response.json();
+                const {data, changed} = await fetchJSONCached('/api/history');
+                if (!changed) return;
                 const historyList = document.getElementById('history-list');
                 
                 if (data.history && data.history.length > 0) {
@@ -1204,8 +1737,7 @@ HTML_TEMPLATE = """
 
         async function getSettings() {
             try {
-                const response = await fetch('/api/settings');
-                const data = await response.json();
+                const {data} = await fetchJSONCached('/api/settings');
                 if (data.success) {
                     return data.settings;
                 }
@@ -1224,7 +1756,9 @@ HTML_TEMPLATE = """
                 mp4box_path: document.getElementById('mp4box_path').value,
                 user_agent: document.getElementById('user_agent').value,
                 upos_host: document.getElementById('upos_host').value,
-                enable_debug: document.getElementById('enable_debug').checked
+                enable_debug: document.getElementById('enable_debug').checked,
+                max_workers: parseInt(document.getElementById('max_workers').value) || 1,
+                max_retries: parseInt(document.getElementById('max_retries').value) || 0
             };
             
             try {
@@ -1249,8 +1783,7 @@ HTML_TEMPLATE = """
 
         async function loadSettings() {
             try {
-                const response = await fetch('/api/settings');
-                const data = await response.json();
+                const {data} = await fetchJSONCached('/api/settings');
                 if (data.success) {
                     document.getElementById('bbdown_path').value = data.settings.bbdown_path || '~/.dotnet/tools/BBDown';
                     document.getElementById('default_dir').value = data.settings.default_dir || '~/Downloads/BBDown-Web';
@@ -1260,6 +1793,8 @@ HTML_TEMPLATE = """
                     document.getElementById('user_agent').value = data.settings.user_agent || '';
                     document.getElementById('upos_host').value = data.settings.upos_host || '';
                     document.getElementById('enable_debug').checked = data.settings.enable_debug || false;
+                    document.getElementById('max_workers').value = data.settings.max_workers || 1;
+                    document.getElementById('max_retries').value = data.settings.max_retries !== undefined ? data.settings.max_retries : 3;
                     currentWorkDir = data.settings.default_dir || '~/Downloads/BBDown-Web';
                     document.getElementById('current-work-dir').textContent = currentWorkDir;
                 }
@@ -1337,19 +1872,15 @@ HTML_TEMPLATE = """
             }
         }
 
-        // 页面加载时更新状态和加载设置
+        // 页面加载时订阅任务事件流并加载设置
         window.addEventListener('load', () => {
-            updateStatus();
+            if (window.EventSource) {
+                connectStatusFeed();
+            } else {
+                startStatusPolling();
+            }
             loadSettings();
         });
-        
-        // 定期更新状态
-        setInterval(() => {
-            const statusTab = document.getElementById('status-tab');
-            if (statusTab.classList.contains('active')) {
-                updateStatus();
-            }
-        }, 5000);
     </script>
 </body>
 </html>
@@ -1382,142 +1913,1851 @@ def extract_url_from_text(text):
     # 如果没有匹配到，返回原始文本
     return text
 
-class DownloadTask:
-    def __init__(self, task_id, url, options):
-        self.id = task_id
-        self.url = url
-        self.options = options
-        self.status = "pending"
-        self.start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.log = ""
-        self.title = url
-        self.progress = 0
+# 每个任务在内存中保留的日志字符数上限
+LOG_BUFFER_MAX_CHARS = 2 * 1024 * 1024
 
-# 配置存储
-app_settings = {
-    'bbdown_path': '~/.dotnet/tools/BBDown',
-    'default_dir': '~/Downloads/BBDown-Web',
-    'aria2c_path': '',
-    'ffmpeg_path': '',
-    'mp4box_path': '',
-    'user_agent': '',
-    'upos_host': '',
-    'enable_debug': False
-}
+class LogBuffer:
+    """追加式分块日志缓冲区
 
-def format_log_line(line):
-    """格式化日志行，添加时间戳和级别标记，确保有换行"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
-    # 如果行为空，只返回换行
-    if not line or line.strip() == '':
-        return '\n'
-    
-    # 识别不同类型的日志行
-    if any(keyword in line for keyword in ['错误', 'ERROR', 'Failed', 'failed']):
-        return f"[{timestamp}] [ERROR] {line}\n"
-    elif any(keyword in line for keyword in ['警告', 'WARNING', 'Warning']):
-        return f"[{timestamp}] [WARN] {line}\n"
-    elif any(keyword in line for keyword in ['成功', 'SUCCESS', 'Completed', '完成', '✅']):
-        return f"[{timestamp}] [SUCCESS] {line}\n"
-    elif any(keyword in line for keyword in ['调试', 'DEBUG', 'Debug']):
-        return f"[{timestamp}] [DEBUG] {line}\n"
-    elif '%' in line:  # 进度信息
-        return f"[{timestamp}] [PROGRESS] {line}\n"
+    日志按块追加，不再拼接整个字符串；offset是单调递增的字符偏移量，
+    超出容量时从头部丢弃旧块，但偏移量保持不变，客户端可以据此增量读取。
+    """
+
+    def __init__(self, max_chars=LOG_BUFFER_MAX_CHARS):
+        self.max_chars = max_chars
+        self.chunks = []
+        self.offsets = []
+        self.start = 0
+        self.end = 0
+        self.memory = 0  # 已保留日志块占用的内存字节数
+        self.lock = threading.Lock()
+
+    @classmethod
+    def restore(cls, text, start):
+        """用转存到磁盘的日志重建缓冲区，保持原来的偏移量"""
+        buffer = cls(max_chars=max(len(text), LOG_BUFFER_MAX_CHARS))
+        buffer.start = buffer.end = start
+        buffer.append(text)
+        return buffer
+
+    def append(self, text):
+        """追加一段日志，返回新的结束偏移量"""
+        if not text:
+            return self.end
+        with self.lock:
+            self.chunks.append(text)
+            self.offsets.append(self.end)
+            self.end += len(text)
+            self.memory += sys.getsizeof(text)
+            if self.end - self.start > self.max_chars:
+                self._trim()
+            return self.end
+
+    def _trim(self):
+        # 一次性丢弃到容量的3/4，避免每次追加都移动列表
+        keep_from = self.end - self.max_chars * 3 // 4
+        index = bisect.bisect_right(self.offsets, keep_from) - 1
+        if index > 0:
+            self.memory -= sum(sys.getsizeof(chunk) for chunk in self.chunks[:index])
+            del self.chunks[:index]
+            del self.offsets[:index]
+            self.start = self.offsets[0]
+
+    def read(self, since=0):
+        """读取since之后的日志，返回(文本, 下一个偏移量, 是否有内容已被丢弃)"""
+        with self.lock:
+            truncated = since < self.start
+            since = min(max(since, self.start), self.end)
+            if since == self.end:
+                return '', self.end, truncated
+            index = bisect.bisect_right(self.offsets, since) - 1
+            first = self.chunks[index][since - self.offsets[index]:]
+            return first + ''.join(self.chunks[index + 1:]), self.end, truncated
+
+    def tail(self, max_chars):
+        """读取最后max_chars个字符"""
+        return self.read(max(self.end - max_chars, self.start))
+
+    def text(self):
+        return self.read(self.start)[0]
+
+# 视频ID：BV号区分大小写，av/ep/ss统一为小写
+VIDEO_ID_RE = re.compile(r'(BV[0-9A-Za-z]{10})|(?<![A-Za-z])(av|ep|ss)(\d+)', re.IGNORECASE)
+PAGE_PARAM_RE = re.compile(r'[?&]p=(\d+)')
+# 课程的ep/ss编号与番剧不是同一套，键中加上cheese:前缀区分
+CHEESE_URL_RE = re.compile(r'/cheese/play/', re.IGNORECASE)
+
+# av号与BV号互转的参数
+BV_ALPHABET = 'FcwAPNKTMug3GV5Lj7EJnHpWsx4tb8haYeviqBz6rkCy12mUSDQX9RdoZf'
+BV_XOR_CODE = 23442827791579
+BV_MAX_AID = 1 << 51
+
+def av_to_bv(aid):
+    """把av号（整数）转换为BV号，超出范围时返回None"""
+    if not 0 < aid < BV_MAX_AID:
+        return None
+    chars = list('BV1000000000')
+    index = len(chars) - 1
+    value = (BV_MAX_AID | aid) ^ BV_XOR_CODE
+    while value:
+        value, digit = divmod(value, 58)
+        chars[index] = BV_ALPHABET[digit]
+        index -= 1
+    chars[3], chars[9] = chars[9], chars[3]
+    chars[4], chars[7] = chars[7], chars[4]
+    return ''.join(chars)
+
+def canonical_video_key(url):
+    """把各种形式的输入归一成视频ID（如BV1xx411c7mD、ep123），分P参数作为后缀
+
+    av号统一转换为对应的BV号，同一个视频不管用哪种形式提交都得到相同的键；
+    课程链接的ep/ss号加上cheese:前缀，与番剧的同号区分开。
+    """
+    match = VIDEO_ID_RE.search(url)
+    if not match:
+        return url.strip()
+    if match.group(1):
+        key = 'BV' + match.group(1)[2:]
+    elif match.group(2).lower() == 'av':
+        key = av_to_bv(int(match.group(3))) or 'av' + match.group(3)
     else:
-        return f"[{timestamp}] [INFO] {line}\n"
+        key = match.group(2).lower() + match.group(3)
+        if CHEESE_URL_RE.search(url):
+            key = 'cheese:' + key
+    page = PAGE_PARAM_RE.search(url)
+    if page and page.group(1) != '1':
+        key += f":p{page.group(1)}"
+    return key
 
-def download_worker():
-    """后台下载线程"""
-    while True:
-        try:
-            task = download_queue.get(timeout=1)
-            if task is None:
-                break
-                
-            task.status = "downloading"
-            download_status[task.id] = task
-            
-            # 构建BBDown命令
-            cmd = build_bbdown_command(task.url, task.options)
-            
+def download_key(url, options):
+    """已下载索引和进行中任务去重用的键：视频ID|分P|画质"""
+    video_id = canonical_video_key(url)
+    page = re.sub(r'\s+', '', options.get('select_page') or '').upper() or 'ALL'
+    quality = (options.get('quality') or '').strip()
+    # 仅音频/仅视频得到的不是完整视频，单独计入
+    if options.get('audio_only'):
+        quality += '#audio'
+    elif options.get('video_only'):
+        quality += '#video'
+    return f"{video_id}|{page}|{quality}"
+
+class EventBus:
+    """全局任务事件总线
+
+    每个事件带有递增的序号，最近的事件保存在环形缓冲区中，
+    断线重连的客户端可以凭Last-Event-ID补发错过的事件。
+    """
+
+    def __init__(self, backlog=1000):
+        self.events = collections.deque(maxlen=backlog)
+        self.seq = 0
+        self.changed = threading.Condition()
+
+    def publish(self, event, data):
+        with self.changed:
+            self.seq += 1
+            self.events.append((self.seq, event, data))
+            self.changed.notify_all()
+            return self.seq
+
+    def since(self, seq):
+        """返回序号seq之后的事件，若部分事件已被丢弃则返回None"""
+        with self.changed:
+            if seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            first = self.events[0][0] if self.events else self.seq + 1
+            if seq + 1 < first:
+                return None
+            return list(itertools.islice(self.events, seq + 1 - first, None))
+
+    def wait(self, seq, timeout):
+        """等待新事件，返回最新序号"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq != seq, timeout)
+            return self.seq
+
+event_bus = EventBus()
+
+class VersionCounter:
+    """数据的版本号，每次修改后调用bump()，用于生成ETag"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+
+# 阶段耗时直方图的分桶上限（秒）
+STAGE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+class Histogram:
+    """Prometheus风格的累积直方图"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """/metrics使用的计数器
+
+    下载线程在事件发生时累加，每次只持有很短的锁；抓取时复制一份快照。
+    只有内存占用统计需要遍历内存中的任务（数量受MAX_RESIDENT_TASKS限制）。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = collections.Counter()
+        self.finished = collections.Counter()
+        self.retries = 0
+        self.bytes_downloaded = 0
+        self.log_lines = 0
+        self.stages = collections.defaultdict(Histogram)
+
+    def task_state(self, old, new):
+        """任务状态变化；结束状态只计入完成计数，不计入当前状态"""
+        with self.lock:
+            if old and old not in FINISHED_STATUSES:
+                self.states[old] -= 1
+            if new in FINISHED_STATUSES:
+                self.finished[new] += 1
+            elif new:
+                self.states[new] += 1
+            if new == 'retry_wait':
+                self.retries += 1
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes_downloaded += count
+
+    def log_line(self):
+        with self.lock:
+            self.log_lines += 1
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].observe(seconds)
+
+    def render(self):
+        """Prometheus文本格式"""
+        resident = resident_stats()
+        with self.lock:
+            states = dict(self.states)
+            finished = dict(self.finished)
+            counters = (self.retries, self.bytes_downloaded, self.log_lines)
+            stages = {name: (list(hist.counts), hist.sum, hist.count, hist.buckets)
+                      for name, hist in self.stages.items()}
+        retries, bytes_downloaded, log_lines = counters
+        # 下载中和暂停的任务各占用一个工作线程
+        busy_workers = states.get('downloading', 0) + states.get('paused', 0)
+        
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP bbdown_web_{name} {help_text}")
+            lines.append(f"# TYPE bbdown_web_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"bbdown_web_{name}{labels} {value}")
+        
+        metric('queue_depth', 'gauge', '排队中的任务数', [('', download_queue.qsize())])
+        metric('workers', 'gauge', '下载线程数', [
+            ('{state="busy"}', busy_workers),
+            ('{state="idle"}', max(worker_pool.size - busy_workers, 0))])
+        metric('tasks', 'gauge', '各状态的未结束任务数',
+               [(f'{{state="{state}"}}', states.get(state, 0))
+                for state in ('pending', 'downloading', 'paused', 'retry_wait')])
+        metric('tasks_finished_total', 'counter', '已结束的任务数',
+               [(f'{{status="{status}"}}', finished.get(status, 0)) for status in FINISHED_STATUSES])
+        metric('retries_total', 'counter', '自动重试次数', [('', retries)])
+        metric('downloaded_bytes_total', 'counter', '已下载的字节数', [('', bytes_downloaded)])
+        # 行速率由Prometheus计算：rate(bbdown_web_log_lines_total[1m])
+        metric('log_lines_total', 'counter', '处理的BBDown输出行数', [('', log_lines)])
+        metric('resident_tasks', 'gauge', '内存中保留的任务数', [('', resident['tasks'])])
+        metric('resident_log_bytes', 'gauge', '内存中任务日志占用的字节数', [('', resident['log_bytes'])])
+        
+        lines.append("# HELP bbdown_web_stage_duration_seconds 各阶段耗时")
+        lines.append("# TYPE bbdown_web_stage_duration_seconds histogram")
+        for stage, (counts, total, count, buckets) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'bbdown_web_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'bbdown_web_stage_duration_seconds_sum{{stage="{stage}"}} {total:.3f}')
+            lines.append(f'bbdown_web_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# 本次进程的标识，保证重启后旧的ETag不会误命中
+SERVER_INSTANCE = uuid.uuid4().hex[:8]
+# 任务表的变化大多经过事件总线（序号即版本），这里只记录不发布事件的变化，例如移出内存
+registry_version = VersionCounter()
+history_version = VersionCounter()
+settings_version = VersionCounter()
+
+# 一次扫描提取文本中所有的视频地址，顺序与extract_url_from_text的优先级一致
+# 视频ID前后不能紧挨字母或数字，避免从"Boss2"、"step1"这类单词中截出ss2、ep1
+URL_TOKEN_RE = re.compile(r'https?://[^\s]+|(?<![\w.])b23\.tv/[^\s]+|'
+                          r'(?<![A-Za-z0-9])(?:BV[0-9A-Za-z]{10}(?![0-9A-Za-z])|(?:av|ep|ss)\d+)', re.IGNORECASE)
+
+def extract_urls_from_text(text):
+    """提取文本中所有的B站URL/视频ID，按视频去重并保持出现顺序"""
+    urls = []
+    for match in URL_TOKEN_RE.finditer(text):
+        url = match.group(0)
+        if url.startswith('b23.tv'):
+            url = 'https://' + url
+        urls.append(url)
+    return unique_video_urls(urls)
+
+def unique_video_urls(urls):
+    """按视频ID去重，保持出现顺序"""
+    result = []
+    seen = set()
+    for url in urls:
+        key = canonical_video_key(url)
+        if key not in seen:
+            seen.add(key)
+            result.append(url)
+    return result
+
+# 短链接展开服务的地址，默认查询b23.tv，可用环境变量指向其他服务
+SHORT_LINK_BASE = os.environ.get('BBDOWN_WEB_SHORT_LINK_BASE', 'https://b23.tv')
+SHORT_LINK_RE = re.compile(r'^(?:https?://)?(?:b23\.tv|bili2233\.cn)/([0-9A-Za-z]+)', re.IGNORECASE)
+# 展开结果的有效期（秒），查询失败的结果只在内存中短暂缓存
+SHORT_LINK_TTL = 30 * 24 * 3600
+SHORT_LINK_FAILURE_TTL = 300
+SHORT_LINK_TIMEOUT = 5
+SHORT_LINK_CACHE_SIZE = 4096
+
+class ShortLinkResolver:
+    """b23.tv短链接展开
+
+    只请求一次短链接并读取跳转地址（不跟随跳转），结果先查内存缓存，
+    再查数据库中的short_links表，都没有时才发起网络请求。
+    """
+
+    def __init__(self, base=SHORT_LINK_BASE):
+        self.base = base.rstrip('/')
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+
+    def lookup_redirect(self, code):
+        """请求短链接，返回跳转地址；没有跳转时返回None"""
+        parts = urllib.parse.urlsplit(self.base)
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.netloc, timeout=SHORT_LINK_TIMEOUT)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc, timeout=SHORT_LINK_TIMEOUT)
+        try:
+            conn.request('GET', f"{parts.path}/{code}", headers={'User-Agent': 'Mozilla/5.0'})
+            response = conn.getresponse()
+            location = response.getheader('Location')
+            if 300 <= response.status < 400 and location:
+                return urllib.parse.urljoin(f"{self.base}/{code}", location)
+            return None
+        finally:
+            conn.close()
+
+    def resolve(self, url):
+        """把短链接展开为实际地址，其他输入原样返回；展开失败时也原样返回，交给BBDown处理"""
+        match = SHORT_LINK_RE.match(url.strip())
+        if not match:
+            return url
+        code = match.group(1)
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(code)
+            if cached and cached[1] > now:
+                self.cache.move_to_end(code)
+                return cached[0] or url
+        
+        target = task_store.load_short_link(code, now - SHORT_LINK_TTL) if task_store else None
+        if target is None:
+            try:
+                target = self.lookup_redirect(code)
+            except (OSError, http.client.HTTPException) as e:
+                print(f"展开短链接失败 {url}: {e}")
+                target = None
+            if target and task_store:
+                task_store.save_short_link(code, target)
+        
+        with self.lock:
+            self.cache[code] = (target, now + (SHORT_LINK_TTL if target else SHORT_LINK_FAILURE_TTL))
+            while len(self.cache) > SHORT_LINK_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return target or url
+
+short_link_resolver = ShortLinkResolver()
+
+def resolve_video_urls(urls):
+    """并行展开列表中的短链接，顺序不变"""
+    short_links = list({url for url in urls if SHORT_LINK_RE.match(url)})
+    if not short_links:
+        return urls
+    with ThreadPoolExecutor(max_workers=min(8, len(short_links))) as executor:
+        resolved = dict(zip(short_links, executor.map(short_link_resolver.resolve, short_links)))
+    return [resolved.get(url, url) for url in urls]
+
+class DownloadTask:
+    def __init__(self, task_id, url, options):
+        self.id = task_id
+        self.url = url
+        self.options = options
+        self.status = "pending"
+        self.start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.log = LogBuffer()
+        self.title = url
+        self.progress = 0
+        self.slot = None
+        self.stream = None
+        self.transfer = {}
+        self.created_at = time.time()
+        self.video_key = download_key(url, options)
+        self.priority = task_priority(options)
+        self.process = None
+        self.cancel_requested = False
+        self.retries = 0
+        self.failure = None
+        self.retry_at = None
+        self.retry_timer = None
+        self.queued_at = self.created_at
+        # BBDown进程树的资源用量，自动重试时累加
+        self.resources = {}
+        # 各阶段的起止时间，end为None表示进行中
+        self.timeline = []
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def notify(self):
+        """唤醒正在等待该任务变化的事件流"""
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """等待任务发生变化，返回最新的版本号"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def append_log(self, text):
+        self.log.append(text)
+        self.notify()
+
+    def begin_stage(self, stage, part=None, start=None):
+        """结束当前阶段并开始新的阶段，与当前阶段相同时忽略"""
+        current = self.timeline[-1] if self.timeline else None
+        if current and current['end'] is None and (current['stage'], current['part']) == (stage, part):
+            return
+        now = time.time()
+        timeline = self._close_stage(now)
+        timeline.append({'stage': stage, 'part': part, 'attempt': self.retries,
+                         'start': round(start or now, 3), 'end': None})
+        self.update(timeline=timeline)
+
+    def end_stage(self):
+        if self.timeline and self.timeline[-1]['end'] is None:
+            self.update(timeline=self._close_stage(time.time()))
+
+    def _close_stage(self, end):
+        """复制时间线并结束进行中的阶段，阶段耗时计入metrics"""
+        timeline = list(self.timeline)
+        if timeline and timeline[-1]['end'] is None:
+            stage = dict(timeline[-1], end=round(end, 3))
+            timeline[-1] = stage
+            metrics.observe_stage(stage['stage'], stage['end'] - stage['start'])
+        return timeline
+
+    def update(self, **fields):
+        """修改任务字段，通知事件流并向事件总线发布变化"""
+        changes = {}
+        old_status = self.status
+        for key, value in fields.items():
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                changes[key] = value
+        if not changes:
+            return
+        self.notify()
+        if 'status' in changes:
+            metrics.task_state(old_status, self.status)
+        if 'priority' in changes:
+            self.options['priority'] = self.priority
+        if task_store and changes.keys() & {'status', 'title', 'priority'}:
+            task_store.save_task(self)
+        
+        status = changes.get('status')
+        if status in FINISHED_STATUSES:
+            event_bus.publish(f"task-{status}", self.to_dict())
+        elif status == 'downloading' and 'slot' in changes:
+            # 暂停后继续也会回到downloading，但不是新开始的任务
+            event_bus.publish('task-started', self.to_dict())
+        elif set(changes) <= {'progress', 'transfer', 'stream', 'resources'}:
+            event_bus.publish('task-progress', dict(changes, id=self.id))
+        else:
+            event_bus.publish('task-updated', dict(changes, id=self.id))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'title': self.title,
+            'status': self.status,
+            'start_time': self.start_time,
+            'progress': self.progress,
+            'slot': self.slot,
+            'stream': self.stream,
+            'transfer': self.transfer,
+            'priority': self.priority,
+            'queue_position': download_queue.position(self) if self.status == 'pending' else None,
+            'retries': self.retries,
+            'failure': self.failure,
+            'retry_at': self.retry_at,
+            'resources': self.resources,
+            'timeline': self.timeline
+        }
+
+# 任务结束状态
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+def task_priority(options):
+    """从下载选项中读取优先级，数值越大越先下载"""
+    try:
+        return int(options.get('priority') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class PriorityTaskQueue:
+    """按优先级排序的下载队列
+
+    接口与queue.Queue一致（put、get(timeout)、qsize，取不到时抛出queue.Empty），
+    另外支持修改优先级、置顶、重新排序和移除排队中的任务。
+    队列按(优先级, 顺序)升序保存，从尾部取出：优先级高的先下载，同优先级先进先出。
+    None是工作线程的退出信号，总是最先取出。
+    """
+
+    def __init__(self):
+        self.items = []
+        self.keys = {}
+        # 普通入队的顺序值递减，置顶的顺序值递增，保证置顶的排在同优先级最前面
+        self.back_order = itertools.count(0, -1)
+        self.front_order = itertools.count(1)
+        self.sentinels = 0
+        self.not_empty = threading.Condition()
+
+    def put(self, task):
+        with self.not_empty:
+            if task is None:
+                self.sentinels += 1
+            else:
+                self._insert(task, (task.priority, next(self.back_order)))
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.sentinels or self.items, timeout if block else 0):
+                raise queue.Empty
+            if self.sentinels:
+                self.sentinels -= 1
+                return None
+            task = self.items.pop()[2]
+            del self.keys[task.id]
+            return task
+
+    def put_back(self, task):
+        """放回刚取出但没有开始的任务：get()从同优先级的最前面取出，放回原来的位置"""
+        with self.not_empty:
+            self._insert(task, (task.priority, next(self.front_order)))
+            self.not_empty.notify()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def _insert(self, task, key):
+        self.keys[task.id] = key
+        bisect.insort(self.items, key + (task,))
+
+    def _take(self, task_id):
+        key = self.keys.pop(task_id, None)
+        if key is None:
+            return None
+        return self.items.pop(bisect.bisect_left(self.items, key))[2]
+
+    def position(self, task):
+        """任务在队列中的位置（0表示下一个），不在队列中返回None"""
+        with self.not_empty:
+            key = self.keys.get(task.id)
+            if key is None:
+                return None
+            return len(self.items) - 1 - bisect.bisect_left(self.items, key)
+
+    def remove(self, task):
+        with self.not_empty:
+            return self._take(task.id) is not None
+
+    def set_priority(self, task, priority):
+        """修改排队中任务的优先级，保持原来的入队顺序；任务不在队列中返回False"""
+        with self.not_empty:
+            key = self.keys.get(task.id)
+            if key is None:
+                return False
+            self._take(task.id)
+            self._insert(task, (priority, key[1]))
+            return True
+
+    def move_to_front(self, task):
+        """把任务移到队首，必要时提高优先级；返回新的优先级，任务不在队列中返回None"""
+        with self.not_empty:
+            if self._take(task.id) is None:
+                return None
+            priority = max(task.priority, self.items[-1][0]) if self.items else task.priority
+            self._insert(task, (priority, next(self.front_order)))
+            return priority
+
+    def reorder(self, task_ids):
+        """按task_ids的顺序重排这些任务，它们占据的队列位置不变
+
+        返回{任务ID: 新优先级}，不在队列中的ID被忽略
+        """
+        with self.not_empty:
+            task_ids = [task_id for task_id in dict.fromkeys(task_ids) if task_id in self.keys]
+            slots = sorted((self.keys[task_id] for task_id in task_ids), reverse=True)
+            tasks = [self._take(task_id) for task_id in task_ids]
+            for task, key in zip(tasks, slots):
+                self._insert(task, key)
+            return {task.id: key[0] for task, key in zip(tasks, slots)}
+
+    def snapshot(self, limit=None):
+        """按下载顺序返回排队中的任务"""
+        with self.not_empty:
+            items = self.items if limit is None else self.items[-limit:]
+            return [item[2] for item in reversed(items)]
+
+download_queue = PriorityTaskQueue()
+
+# 配置存储
+app_settings = {
+    'bbdown_path': '~/.dotnet/tools/BBDown',
+    'default_dir': '~/Downloads/BBDown-Web',
+    'aria2c_path': '',
+    'ffmpeg_path': '',
+    'mp4box_path': '',
+    'user_agent': '',
+    'upos_host': '',
+    'enable_debug': False,
+    'max_workers': 2,
+    'max_retries': 3
+}
+
+# 同时运行的下载任务数上限
+MAX_WORKERS_LIMIT = 16
+
+# 内存中保留的历史记录条数，更早的只保存在数据库中
+HISTORY_MEMORY_LIMIT = 1000
+
+class TaskStore:
+    """基于SQLite(WAL模式)的任务、历史和设置存储
+
+    写操作先在内存中合并（同一任务只保留最新状态），由后台线程定期批量提交，
+    下载线程和请求线程不会等待磁盘IO。
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            options TEXT NOT NULL,
+            status TEXT NOT NULL,
+            title TEXT,
+            progress INTEGER NOT NULL DEFAULT 0,
+            start_time TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            title TEXT,
+            url TEXT,
+            time TEXT,
+            status TEXT,
+            video_key TEXT
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS short_links (
+            code TEXT PRIMARY KEY,
+            target TEXT NOT NULL,
+            resolved_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path, flush_interval=0.5):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        # 旧版本创建的数据库没有video_key列
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(history)')}
+        if 'video_key' not in columns:
+            self.conn.execute('ALTER TABLE history ADD COLUMN video_key TEXT')
+        self.db_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending_tasks = {}
+        self.pending_ops = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._writer, name="task-store-writer", daemon=True)
+        self.thread.start()
+
+    def save_task(self, task):
+        record = (task.id, task.url, json.dumps(task.options, ensure_ascii=False), task.status,
+                  task.title, task.progress, task.start_time, task.created_at, time.time())
+        with self.lock:
+            self.pending_tasks[task.id] = record
+
+    def add_history(self, entry):
+        with self.lock:
+            self.pending_ops.append(('INSERT INTO history (task_id, title, url, time, status, video_key) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     (entry.get('task_id'), entry['title'], entry['url'], entry['time'],
+                                      entry['status'], entry.get('video_key'))))
+
+    def clear_history(self):
+        with self.lock:
+            self.pending_ops.append(('DELETE FROM history', ()))
+
+    def save_settings(self, settings):
+        with self.lock:
+            for key, value in settings.items():
+                self.pending_ops.append(('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                                         (key, json.dumps(value, ensure_ascii=False))))
+
+    def load_settings(self):
+        with self.db_lock:
+            rows = self.conn.execute('SELECT key, value FROM settings').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def load_history(self, limit=HISTORY_MEMORY_LIMIT):
+        """按时间顺序返回最近limit条历史"""
+        with self.db_lock:
+            rows = self.conn.execute(
+                'SELECT task_id, title, url, time, status FROM history ORDER BY id DESC LIMIT ?',
+                (limit,)).fetchall()
+        return [{'task_id': task_id, 'title': title, 'url': url, 'time': time_text, 'status': status}
+                for task_id, title, url, time_text, status in reversed(rows)]
+
+    def save_short_link(self, code, target):
+        with self.lock:
+            self.pending_ops.append(('INSERT OR REPLACE INTO short_links (code, target, resolved_at) VALUES (?, ?, ?)',
+                                     (code, target, time.time())))
+
+    def load_short_link(self, code, not_before):
+        """返回not_before之后展开过的短链接目标，没有则返回None"""
+        with self.db_lock:
+            row = self.conn.execute('SELECT target FROM short_links WHERE code = ? AND resolved_at >= ?',
+                                    (code, not_before)).fetchone()
+        return row[0] if row else None
+
+    def load_completed_downloads(self):
+        """返回历史中所有成功下载的(video_key, task_id, title, time)，按时间顺序"""
+        with self.db_lock:
+            return self.conn.execute(
+                "SELECT video_key, task_id, title, time FROM history "
+                "WHERE status = 'completed' AND video_key IS NOT NULL ORDER BY id").fetchall()
+
+    def load_unfinished_tasks(self):
+        """返回上次退出时还在排队或下载中的任务，按创建时间排序"""
+        with self.db_lock:
+            return self.conn.execute(
+                "SELECT id, url, options, title, start_time, created_at FROM tasks "
+                "WHERE status IN ('pending', 'downloading', 'paused', 'retry_wait') ORDER BY created_at").fetchall()
+
+    def flush(self):
+        with self.lock:
+            tasks = list(self.pending_tasks.values())
+            ops = self.pending_ops
+            self.pending_tasks = {}
+            self.pending_ops = []
+        if not tasks and not ops:
+            return
+        with self.db_lock, self.conn:
+            if tasks:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO tasks (id, url, options, status, title, progress, start_time, '
+                    'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', tasks)
+            for sql, params in ops:
+                self.conn.execute(sql, params)
+
+    def _writer(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"写入任务数据库失败: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.conn.close()
+
+task_store = None
+
+def init_task_store(path=None):
+    """打开任务数据库，恢复设置和历史，并把未完成的任务重新加入队列"""
+    global task_store, download_history
+    task_store = TaskStore(path or os.path.join(DATA_DIR, 'bbdown_web.db'))
+    atexit.register(task_store.close)
+    
+    for key, value in task_store.load_settings().items():
+        if key in app_settings:
+            app_settings[key] = value
+    download_history = task_store.load_history()
+    history_version.bump()
+    settings_version.bump()
+    download_index.load_history(task_store.load_completed_downloads())
+    
+    restored = []
+    for task_id, url, options, title, start_time, created_at in task_store.load_unfinished_tasks():
+        task = DownloadTask(task_id, url, json.loads(options))
+        task.title = title or url
+        task.start_time = start_time
+        task.created_at = created_at
+        task.append_log(format_log_line("⚠️ 服务重启，任务已重新加入队列"))
+        # 清理上次中断留下的临时文件
+        work_dir = os.path.expanduser(task.options.get('work_dir') or DEFAULT_WORK_DIR)
+        remove_stage_dir(get_task_stage_dir(work_dir, task_id))
+        restored.append(task)
+    for task in restored:
+        register_task(task)
+    return len(restored)
+
+def record_history(task):
+    """把结束的任务写入下载历史，成功的同时记入已下载索引"""
+    entry = {
+        'task_id': task.id,
+        'title': task.title,
+        'url': task.url,
+        'time': task.start_time,
+        'status': task.status,
+        'video_key': task.video_key
+    }
+    with download_lock:
+        release_active_download(task)
+        download_history.append(entry)
+        if len(download_history) > HISTORY_MEMORY_LIMIT:
+            del download_history[:len(download_history) - HISTORY_MEMORY_LIMIT]
+    history_version.bump()
+    if task.status == 'completed':
+        download_index.add(task.video_key, entry)
+    if task_store:
+        task_store.add_history(entry)
+
+# 排队或下载中的任务，按download_key索引，相同的提交直接关联到已有任务
+active_downloads = {}
+
+def release_active_download(task):
+    """任务结束后不再接受关联"""
+    with download_lock:
+        if active_downloads.get(task.video_key) is task:
+            del active_downloads[task.video_key]
+
+# 下载目录的重新扫描间隔（秒）
+DOWNLOAD_SCAN_INTERVAL = 30
+
+class DownloadIndex:
+    """已下载视频索引
+
+    来源有两个：下载历史中成功的任务（按视频ID|分P|画质精确匹配），
+    以及默认下载目录中文件名带BV/av号的文件（只按视频ID匹配，且仅对默认画质的请求生效）。
+    目录扫描是增量的：记录每个目录的mtime，没变的目录只stat不重新列出文件。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.entries = {}
+        self.root = None
+        self.dirs = {}
+        self.disk_ids = {}
+        self.scanned_at = 0
+
+    def load_history(self, rows):
+        with self.lock:
+            for video_key, task_id, title, time_text in rows:
+                self.entries[video_key] = {'task_id': task_id, 'title': title, 'time': time_text}
+
+    def add(self, video_key, entry):
+        with self.lock:
+            self.entries[video_key] = {'task_id': entry['task_id'], 'title': entry['title'], 'time': entry['time']}
+
+    def clear_history(self):
+        with self.lock:
+            self.entries.clear()
+
+    def lookup(self, video_key):
+        """返回已下载的记录，没有则返回None"""
+        with self.lock:
+            entry = self.entries.get(video_key)
+            if entry:
+                return entry
+            video_id, _, quality = video_key.split('|')
+            if quality:
+                return None
+            # 去掉分P后缀；课程的cheese:前缀保留，不会与文件名中的BV/av号混淆
+            path = self.disk_ids.get(re.sub(r':p\d+$', '', video_id))
+        if path:
+            return {'task_id': None, 'title': os.path.basename(path), 'path': path}
+        return None
+
+    def refresh(self, root, max_age=DOWNLOAD_SCAN_INTERVAL):
+        """扫描下载目录；距上次扫描不足max_age秒或已有扫描在进行时直接返回"""
+        root = os.path.expanduser(root)
+        if root == self.root and time.time() - self.scanned_at < max_age:
+            return
+        if not self.scan_lock.acquire(blocking=False):
+            return
+        try:
+            if root != self.root:
+                self.root, self.dirs = root, {}
+            self._scan(root)
+            self.scanned_at = time.time()
+        finally:
+            self.scan_lock.release()
+
+    def _scan(self, root):
+        seen = set()
+        changed = False
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(path)
+            cached = self.dirs.get(path)
+            if cached is None or cached[0] != mtime:
+                ids, subdirs = {}, []
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            if entry.name.startswith('.'):
+                                continue  # 跳过隐藏目录，包括任务的临时目录
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            else:
+                                for match in VIDEO_ID_RE.finditer(entry.name):
+                                    # 文件名中的ep/ss号分不清是番剧还是课程，只认BV/av号
+                                    if match.group(1) or match.group(2).lower() == 'av':
+                                        ids.setdefault(canonical_video_key(match.group(0)), entry.path)
+                except OSError:
+                    continue
+                cached = self.dirs[path] = (mtime, ids, subdirs)
+                changed = True
+            stack.extend(cached[2])
+        
+        for path in [path for path in self.dirs if path not in seen]:
+            del self.dirs[path]
+            changed = True
+        if changed:
+            disk_ids = {}
+            for _, ids, _ in self.dirs.values():
+                for video_id, path in ids.items():
+                    disk_ids.setdefault(video_id, path)
+            with self.lock:
+                self.disk_ids = disk_ids
+
+download_index = DownloadIndex()
+
+# 内存中保留的已结束任务数和日志内存上限，超出后最久未访问的任务日志转存到磁盘
+MAX_RESIDENT_TASKS = 200
+MAX_RESIDENT_LOG_BYTES = 64 * 1024 * 1024
+# 已结束的任务，按最近访问顺序排列
+finished_lru = collections.OrderedDict()
+# 最近从磁盘读回的日志
+spilled_log_cache = collections.OrderedDict()
+SPILLED_LOG_CACHE_SIZE = 8
+
+def spilled_log_path(task_id):
+    return os.path.join(DATA_DIR, 'logs', f"{task_id}.log.gz")
+
+def resident_stats():
+    """内存中的任务数量和日志占用的字节数"""
+    with download_lock:
+        tasks = list(download_status.values())
+    return {'tasks': len(tasks), 'log_bytes': sum(task.log.memory for task in tasks)}
+
+def touch_finished_task(task_id):
+    with download_lock:
+        if task_id in finished_lru:
+            finished_lru.move_to_end(task_id)
+
+def spill_task_log(task):
+    """把任务日志压缩保存到磁盘，第一行是任务状态等元数据"""
+    path = spilled_log_path(task.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = {
+        'title': task.title,
+        'status': task.status,
+        'progress': task.progress,
+        'timeline': task.timeline,
+        'start': task.log.start
+    }
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(meta, ensure_ascii=False) + '\n')
+        f.write(task.log.text())
+    os.replace(path + '.tmp', path)
+
+def load_spilled_log(task_id):
+    """读取转存的日志，返回(元数据, LogBuffer)，不存在时返回None"""
+    with download_lock:
+        if task_id in spilled_log_cache:
+            spilled_log_cache.move_to_end(task_id)
+            return spilled_log_cache[task_id]
+    if not re.fullmatch(r'[\w-]+', task_id):
+        return None
+    try:
+        with gzip.open(spilled_log_path(task_id), 'rt', encoding='utf-8') as f:
+            meta = json.loads(f.readline())
+            log = LogBuffer.restore(f.read(), meta['start'])
+    except (OSError, ValueError):
+        return None
+    with download_lock:
+        spilled_log_cache[task_id] = (meta, log)
+        while len(spilled_log_cache) > SPILLED_LOG_CACHE_SIZE:
+            spilled_log_cache.popitem(last=False)
+    return meta, log
+
+def retire_finished_task(task):
+    """任务结束后加入LRU，超出内存上限时把最久未访问的任务转存到磁盘并移出内存"""
+    with download_lock:
+        finished_lru[task.id] = None
+        finished_lru.move_to_end(task.id)
+        log_bytes = sum(item.log.memory for item in download_status.values())
+        victims = []
+        while finished_lru and (len(finished_lru) > MAX_RESIDENT_TASKS or log_bytes > MAX_RESIDENT_LOG_BYTES):
+            task_id, _ = finished_lru.popitem(last=False)
+            victim = download_status.get(task_id)
+            if victim:
+                victims.append(victim)
+                log_bytes -= victim.log.memory
+    
+    # 先写磁盘再移出内存，避免中间时刻查不到日志
+    for victim in victims:
+        try:
+            spill_task_log(victim)
+        except OSError as e:
+            print(f"转存任务日志失败: {e}")
+        with download_lock:
+            download_status.pop(victim.id, None)
+        registry_version.bump()
+
+# 日志级别关键字，按优先级从高到低排列
+LOG_LEVEL_KEYWORDS = [
+    ('ERROR', ['错误', 'ERROR', 'Failed', 'failed']),
+    ('WARN', ['警告', 'WARNING', 'Warning']),
+    ('SUCCESS', ['成功', 'SUCCESS', 'Completed', '完成', '✅']),
+    ('DEBUG', ['调试', 'DEBUG', 'Debug']),
+    ('PROGRESS', ['%']),
+]
+LOG_LEVEL_PRIORITY = {level: index for index, (level, _) in enumerate(LOG_LEVEL_KEYWORDS)}
+
+# 关键字到类别的映射，标题前缀也放在一起，一次扫描得到全部信息
+LOG_KEYWORD_KINDS = {keyword: level for level, keywords in LOG_LEVEL_KEYWORDS for keyword in keywords}
+LOG_KEYWORD_KINDS.update({'视频标题:': 'TITLE', 'Title:': 'TITLE'})
+
+# 只包含字面量的多关键字正则，re可以按首字符快速跳过无关字符
+LOG_CLASSIFIER_RE = re.compile('|'.join(
+    re.escape(keyword) for keyword in sorted(LOG_KEYWORD_KINDS, key=len, reverse=True)))
+PERCENT_VALUE_RE = re.compile(r'\d+(?:\.\d+)?$')
+
+def classify_log_line(line):
+    """单次扫描日志行，返回(级别, 进度百分比或None, 视频标题或None)"""
+    level = 'INFO'
+    rank = len(LOG_LEVEL_KEYWORDS)
+    progress = None
+    title = None
+    for match in LOG_CLASSIFIER_RE.finditer(line):
+        kind = LOG_KEYWORD_KINDS[match.group()]
+        if kind == 'TITLE':
+            if title is None:
+                title = line[match.end():].strip() or None
+            continue
+        if kind == 'PROGRESS' and progress is None:
+            # 取紧挨在%前面的数字
+            value = PERCENT_VALUE_RE.search(line, 0, match.start())
+            if value:
+                progress = min(int(float(value.group())), 100)
+        if LOG_LEVEL_PRIORITY[kind] < rank:
+            rank = LOG_LEVEL_PRIORITY[kind]
+            level = kind
+    return level, progress, title
+
+_timestamp_cache = (0, '')
+
+def log_timestamp():
+    """当前时间的HH:MM:SS字符串，同一秒内复用缓存"""
+    global _timestamp_cache
+    now = int(time.time())
+    second, text = _timestamp_cache
+    if second != now:
+        text = time.strftime("%H:%M:%S", time.localtime(now))
+        _timestamp_cache = (now, text)
+    return text
+
+def format_log_line(line, level=None):
+    """格式化日志行，添加时间戳和级别标记，确保有换行；level为None时自动识别"""
+    # 如果行为空，只返回换行
+    if not line or line.isspace():
+        return '\n'
+    
+    if level is None:
+        level = classify_log_line(line)[0]
+    return f"[{log_timestamp()}] [{level}] {line}\n"
+
+class WorkerPool:
+    """下载工作线程池，每个线程固定占用一个槽位编号"""
+
+    def __init__(self, target):
+        self.target = target
+        self.size = 0
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def resize(self, size):
+        """调整槽位数量：扩容时立即启动新线程，缩容时多余线程在完成当前任务后退出"""
+        size = max(1, min(int(size), MAX_WORKERS_LIMIT))
+        with self.lock:
+            self.size = size
+            for slot in range(size):
+                if slot not in self.threads:
+                    thread = threading.Thread(target=self.target, args=(slot,),
+                                              name=f"download-worker-{slot}", daemon=True)
+                    self.threads[slot] = thread
+                    thread.start()
+        return size
+
+    def retire(self, slot, force=False):
+        """工作线程在取任务前后调用，返回True表示该槽位应当退出"""
+        with self.lock:
+            if force or slot >= self.size:
+                self.threads.pop(slot, None)
+                return True
+            return False
+
+    def stop(self):
+        """发送结束信号，每个线程消费一个None后退出"""
+        with self.lock:
+            count = len(self.threads)
+        for _ in range(count):
+            download_queue.put(None)
+
+    def busy_slots(self):
+        with download_lock:
+            return sorted(task.slot for task in download_status.values()
+                          if task.slot is not None)
+
+def get_task_stage_dir(work_dir, task_id):
+    """每个任务独立的临时工作目录，避免并行的BBDown互相覆盖临时文件"""
+    return os.path.join(work_dir, '.bbdown-tasks', task_id)
+
+def unique_path(path):
+    """path已存在时返回"名称 (1).扩展名"这样不冲突的新路径"""
+    stem, ext = os.path.splitext(path)
+    index = 1
+    while os.path.lexists(f"{stem} ({index}){ext}"):
+        index += 1
+    return f"{stem} ({index}){ext}"
+
+def merge_move_tree(src, dst, log=None):
+    """把src下的所有文件移动到dst，同名目录合并，不覆盖下载目录中已有的文件
+
+    BBDown在空的临时目录中运行，发现不了目标目录里已有的文件，这里代替它处理同名文件：
+    内容逐字节相同时保留原文件并丢弃新下载的副本，否则新文件改名保存，不会丢失任何一方。
+    log用于记录每个同名文件的处理方式。
+    """
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.isdir(src_path) and os.path.isdir(dst_path):
+            merge_move_tree(src_path, dst_path, log)
+            os.rmdir(src_path)
+        elif not os.path.lexists(dst_path):
+            shutil.move(src_path, dst_path)
+        elif (os.path.isfile(src_path) and os.path.isfile(dst_path)
+              and filecmp.cmp(src_path, dst_path, shallow=False)):
+            os.remove(src_path)
+            if log:
+                log(f"文件已存在且内容相同，保留原文件: {dst_path}")
+        else:
+            new_path = unique_path(dst_path)
+            shutil.move(src_path, new_path)
+            if log:
+                log(f"已存在同名文件，新文件保存为: {new_path}")
+
+# 单行日志的最大字符数，超出部分拆成多行
+MAX_LOG_LINE_CHARS = 8192
+# 每次从子进程管道读取的字节数
+OUTPUT_READ_SIZE = 65536
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n')
+
+def iter_output_lines(stream, max_chars=MAX_LOG_LINE_CHARS):
+    """逐行读取子进程的原始输出，返回(行, 是否为\\r结尾的重绘行)
+
+    BBDown和aria2c用\\r重绘进度条，这里同时按\\r和\\n切分（\\r\\n算一次换行），
+    有数据就立即处理而不等待换行；按UTF-8增量解码，单行长度不超过max_chars。
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    fd = stream.fileno()
+    pending = ''
+    while True:
+        chunk = os.read(fd, OUTPUT_READ_SIZE)
+        pending += decoder.decode(chunk, final=not chunk)
+        pos = 0
+        for match in LINE_BREAK_RE.finditer(pending):
+            # 末尾单独的\r可能是被拆开的\r\n，留到下一块数据再判断
+            if chunk and match.end() == len(pending) and match.group() == '\r':
+                break
+            line = pending[pos:match.start()]
+            while len(line) > max_chars:
+                yield line[:max_chars], False
+                line = line[max_chars:]
+            yield line, match.group() == '\r'
+            pos = match.end()
+        pending = pending[pos:]
+        while len(pending) > max_chars:
+            yield pending[:max_chars], False
+            pending = pending[max_chars:]
+        if not chunk:
+            if pending:
+                yield pending, False
+            return
+
+# 进度写回任务对象的最小间隔（秒）
+PROGRESS_UPDATE_INTERVAL = 0.25
+
+SIZE_UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+SIZE_PATTERN = r'(\d+(?:\.\d+)?)\s*([KMGT]?)i?B'
+TRANSFER_SIZE_RE = re.compile(SIZE_PATTERN + r'\s*/\s*' + SIZE_PATTERN)
+TRANSFER_SPEED_RE = re.compile(SIZE_PATTERN + r'/s|DL:\s*' + SIZE_PATTERN)
+TRANSFER_ETA_RE = re.compile(r'ETA:\s*(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?')
+STREAM_MARKER_RE = re.compile(r'开始下载P?\d*(视频|音频)')
+# BBDown输出中标志各阶段开始的文字，"任务完成"结束最后一个阶段
+STAGE_MARKER_RE = re.compile(
+    r'(?P<info>获取aid(?!结束))|开始下载P?(?P<part>\d*)(?P<stream>视频|音频)|'
+    r'(?P<extras>下载(?:封面|字幕|弹幕)|弹幕Xml)|(?P<mux>开始合并|开始混流)|(?P<done>任务完成)')
+
+def match_stage(line):
+    """识别阶段标记，返回(阶段, 分P)；不是阶段标记时返回None"""
+    match = STAGE_MARKER_RE.search(line)
+    if not match:
+        return None
+    if match.group('stream'):
+        return ('audio' if match.group('stream') == '音频' else 'video'), match.group('part') or None
+    return match.lastgroup, None
+
+def parse_size(value, unit):
+    return int(float(value) * SIZE_UNITS[unit or 'B'])
+
+def parse_transfer_line(line):
+    """从BBDown/aria2c的进度行中解析已下载/总大小、速度和剩余时间"""
+    info = {}
+    sizes = TRANSFER_SIZE_RE.search(line)
+    if sizes:
+        info['downloaded'] = parse_size(sizes.group(1), sizes.group(2))
+        info['total'] = parse_size(sizes.group(3), sizes.group(4))
+    # 速度：BBDown为"5.23MB/s"，aria2c为"DL:5.2MiB"
+    speed = TRANSFER_SPEED_RE.search(line, sizes.end() if sizes else 0)
+    if speed:
+        if speed.group(1):
+            info['speed'] = parse_size(speed.group(1), speed.group(2))
+        else:
+            info['speed'] = parse_size(speed.group(3), speed.group(4))
+    eta = TRANSFER_ETA_RE.search(line)
+    if eta and any(eta.groups()):
+        hours, minutes, seconds = (int(value or 0) for value in eta.groups())
+        info['eta'] = hours * 3600 + minutes * 60 + seconds
+    elif info.get('speed') and 'total' in info:
+        info['eta'] = max(info['total'] - info['downloaded'], 0) // info['speed']
+    return info
+
+class ProgressTracker:
+    """把高频的进度输出合并成对任务对象的低频更新
+
+    视频流和音频流分别记录已下载/总字节数、速度和剩余时间，
+    两次写回任务之间至少间隔PROGRESS_UPDATE_INTERVAL秒。
+    """
+
+    def __init__(self, task, interval=PROGRESS_UPDATE_INTERVAL):
+        self.task = task
+        self.interval = interval
+        self.stream = task.stream or 'video'
+        self.transfer = dict(task.transfer)
+        self.progress = task.progress
+        self.dirty = False
+        self.last_flush = 0
+        # 已计入metrics的下载量，按流记录
+        self.counted = {stream: info.get('downloaded', 0) for stream, info in self.transfer.items()}
+
+    def start_stream(self, line):
+        """遇到"开始下载P1视频/音频"时切换当前流"""
+        match = STREAM_MARKER_RE.search(line)
+        if match:
+            self.flush()
+            self.stream = 'audio' if match.group(1) == '音频' else 'video'
+            self.progress = 0
+            self.dirty = True
+
+    def feed(self, line, progress):
+        info = parse_transfer_line(line)
+        if progress is not None:
+            info['percent'] = progress
+            self.progress = progress
+        if not info:
+            return
+        self.transfer[self.stream] = dict(self.transfer.get(self.stream, {}), **info)
+        self.dirty = True
+        if progress == 100 or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.last_flush = time.time()
+        for stream, info in self.transfer.items():
+            downloaded = info.get('downloaded', 0)
+            # 下一个分P重新从0开始计数，只累加增长的部分
+            if downloaded > self.counted.get(stream, 0):
+                metrics.add_bytes(downloaded - self.counted.get(stream, 0))
+            self.counted[stream] = downloaded
+        self.task.update(progress=self.progress, stream=self.stream,
+                         transfer={key: dict(value) for key, value in self.transfer.items()})
+
+def remove_stage_dir(stage_dir):
+    """删除任务临时目录，没有其他任务在用时一并删除上级目录"""
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(stage_dir))
+    except OSError:
+        pass
+
+# 取消时先发送SIGTERM，超过这个时间（秒）进程还没退出则发送SIGKILL
+CANCEL_KILL_TIMEOUT = 5
+
+def start_download_process(cmd, cwd):
+    """启动BBDown，放在独立的进程组中，取消和暂停时可以连同aria2c、ffmpeg等子进程一起处理"""
+    if os.name == 'nt':
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, cwd=cwd,
+                                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, cwd=cwd,
+                            start_new_session=True)
+
+def signal_process_group(process, sig):
+    """向进程所在的进程组发送信号，进程已退出时忽略"""
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def kill_process_tree(process):
+    """结束下载进程及其所有子进程"""
+    if process.poll() is not None:
+        return
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/T', '/F', '/PID', str(process.pid)], capture_output=True)
+        return
+    signal_process_group(process, signal.SIGTERM)
+    # 已暂停的进程要先恢复才能处理SIGTERM
+    signal_process_group(process, signal.SIGCONT)
+    
+    def force_kill():
+        if process.poll() is None:
+            signal_process_group(process, signal.SIGKILL)
+    timer = threading.Timer(CANCEL_KILL_TIMEOUT, force_kill)
+    timer.daemon = True
+    timer.start()
+
+# 下载进程树资源用量的采样间隔（秒）
+RESOURCE_SAMPLE_INTERVAL = 1.0
+PROC_ROOT = '/proc'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# rusage中ru_maxrss的单位：Linux为KB，macOS为字节
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def read_proc_stat(pid):
+    """读取/proc/<pid>/stat，返回(状态, 进程组, 启动时间, CPU秒数, 常驻内存字节数)"""
+    with open(f'{PROC_ROOT}/{pid}/stat', 'rb') as f:
+        data = f.read()
+    # 进程名可能包含空格和括号，从最后一个')'之后开始按空格切分
+    fields = data[data.rfind(b')') + 2:].split()
+    return (fields[0], int(fields[2]), int(fields[19]),
+            (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE)
+
+def read_proc_io(pid):
+    """读取/proc/<pid>/io中实际读写存储的字节数，没有权限时返回(0, 0)"""
+    counters = {}
+    try:
+        with open(f'{PROC_ROOT}/{pid}/io', 'rb') as f:
+            for line in f:
+                key, _, value = line.partition(b':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get(b'read_bytes', 0), counters.get(b'write_bytes', 0)
+
+class ResourceMonitor:
+    """统计一次下载进程树（BBDown及其启动的aria2c、ffmpeg等）的资源用量
+
+    BBDown运行在独立的进程组中，采样线程定期扫描/proc找出组内的进程，
+    记录每个进程最后一次看到的CPU时间和读写字节数并累加，同时记录整棵树的内存峰值。
+    进程结束时由wait4回收，用得到的rusage补上最后一次采样之后的部分。
+    没有/proc或wait4的系统上对应的数据缺失。
+    """
+
+    def __init__(self, task, process, interval=RESOURCE_SAMPLE_INTERVAL):
+        self.task = task
+        self.process = process
+        self.interval = interval
+        # 自动重试时累加之前几次运行的用量
+        self.base = dict(task.resources)
+        self.procs = {}  # (pid, 启动时间) -> (CPU秒数, 读字节数, 写字节数)
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if not os.path.isdir(PROC_ROOT):
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            # 组内只剩僵尸进程（等待回收）或没有进程时停止采样
+            if not self.sample():
+                break
+            self.task.update(resources=self.usage())
+            if self.stopped.wait(self.interval):
+                break
+
+    def sample(self):
+        """扫描一次进程组，返回仍在运行的进程数"""
+        running = 0
+        rss = 0
+        try:
+            pids = [name for name in os.listdir(PROC_ROOT) if name.isdigit()]
+        except OSError:
+            return 0
+        for pid in pids:
+            try:
+                state, group, started, cpu, memory = read_proc_stat(pid)
+            except (OSError, ValueError, IndexError):
+                continue  # 扫描期间进程已退出
+            if group != self.process.pid:
+                continue
+            if state != b'Z':
+                running += 1
+                rss += memory
+            read_bytes, write_bytes = read_proc_io(pid)
+            previous = self.procs.get((pid, started), (0, 0, 0))
+            self.procs[(pid, started)] = tuple(map(max, previous, (cpu, read_bytes, write_bytes)))
+        self.peak_rss = max(self.peak_rss, rss)
+        return running
+
+    def usage(self, rusage=None):
+        """当前累计用量，rusage为wait4返回的BBDown进程（含它已回收的子进程）用量"""
+        cpu = sum(value[0] for value in self.procs.values())
+        read_bytes = sum(value[1] for value in self.procs.values())
+        write_bytes = sum(value[2] for value in self.procs.values())
+        peak_rss = self.peak_rss
+        processes = len(self.procs)
+        if rusage:
+            cpu = max(cpu, rusage.ru_utime + rusage.ru_stime)
+            read_bytes = max(read_bytes, rusage.ru_inblock * 512)
+            write_bytes = max(write_bytes, rusage.ru_oublock * 512)
+            # Linux上fork出的子进程会继承本服务的内存峰值，有采样数据时以采样为准
+            if not peak_rss:
+                peak_rss = rusage.ru_maxrss * MAXRSS_UNIT
+            processes = max(processes, 1)
+        base = self.base
+        return {
+            'cpu_seconds': round(base.get('cpu_seconds', 0) + cpu, 2),
+            'peak_rss': max(base.get('peak_rss', 0), peak_rss),
+            'read_bytes': base.get('read_bytes', 0) + read_bytes,
+            'write_bytes': base.get('write_bytes', 0) + write_bytes,
+            'processes': base.get('processes', 0) + processes
+        }
+
+    def wait(self):
+        """停止采样，等待进程退出并记录最终用量，返回退出码"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.sample()
+        rusage = None
+        if hasattr(os, 'wait4'):
+            try:
+                _, status, rusage = os.wait4(self.process.pid, 0)
+                # wait4已经回收了进程，Popen无法再取得退出码，需要手动设置
+                self.process.returncode = os.waitstatus_to_exitcode(status)
+            except ChildProcessError:
+                pass  # 取消时已被poll()回收，没有rusage
+        self.process.wait()
+        self.task.update(resources=self.usage(rusage))
+        return self.process.returncode
+
+# 服务器退出时等待下载进程结束的时间（秒），超时后发送SIGKILL
+SHUTDOWN_KILL_TIMEOUT = 5
+# 服务器正在退出，下载线程不再更新被结束的任务
+shutting_down = threading.Event()
+
+def terminate_download_processes(timeout=SHUTDOWN_KILL_TIMEOUT):
+    """服务器退出时结束所有下载进程组
+
+    BBDown运行在独立的会话中，Ctrl+C和docker stop的信号只发给服务器本身，
+    不主动结束的话BBDown、aria2c、ffmpeg会成为孤儿进程继续写临时目录。
+    任务保持未完成状态，下次启动时重新排队。
+    """
+    shutting_down.set()
+    with download_lock:
+        processes = [task.process for task in download_status.values() if task.process]
+    if not processes:
+        return
+    print(f"正在结束 {len(processes)} 个下载进程...")
+    for process in processes:
+        if os.name == 'nt':
+            kill_process_tree(process)
+        else:
+            signal_process_group(process, signal.SIGTERM)
+            signal_process_group(process, signal.SIGCONT)
+    deadline = time.time() + timeout
+    for process in processes:
+        try:
+            process.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            pass
+        if os.name != 'nt':
+            # 进程组中可能还有没响应SIGTERM的子进程
+            signal_process_group(process, signal.SIGKILL)
+
+def finish_cancelled_task(task):
+    """排队中的任务被取消：不会再启动进程，直接结束"""
+    # 已被工作线程取出时排队阶段还没有结束
+    task.end_stage()
+    task.append_log(format_log_line("⛔ 任务已取消"))
+    task.update(status="cancelled", slot=None)
+    record_history(task)
+    retire_finished_task(task)
+
+def cancel_task(task):
+    """取消任务，返回(是否成功, 说明)"""
+    with download_lock:
+        if task.status in FINISHED_STATUSES:
+            return False, '任务已结束'
+        task.cancel_requested = True
+        queued = download_queue.remove(task)
+        if task.status == 'retry_wait':
+            task.retry_timer.cancel()
+            queued = True
+        process = task.process
+    if queued:
+        finish_cancelled_task(task)
+        return True, '已从队列中移除'
+    # 已被工作线程取出：进程已启动则结束进程，否则工作线程启动前会检查取消标记
+    if process:
+        task.append_log(format_log_line("⛔ 正在取消任务..."))
+        kill_process_tree(process)
+    return True, '正在取消任务'
+
+def pause_task(task):
+    """暂停正在下载的任务（SIGSTOP整个进程组），槽位保持占用"""
+    if os.name == 'nt':
+        return False, 'Windows下不支持暂停'
+    with download_lock:
+        if task.status != 'downloading' or not task.process or task.cancel_requested:
+            return False, '只能暂停正在下载的任务'
+        signal_process_group(task.process, signal.SIGSTOP)
+        task.update(status='paused')
+    task.append_log(format_log_line("⏸️ 任务已暂停"))
+    return True, '任务已暂停'
+
+def resume_task(task):
+    """继续已暂停的任务"""
+    with download_lock:
+        if task.status != 'paused' or not task.process:
+            return False, '任务没有暂停'
+        signal_process_group(task.process, signal.SIGCONT)
+        task.update(status='downloading')
+    task.append_log(format_log_line("▶️ 任务继续下载"))
+    return True, '任务继续下载'
+
+def status_code_pattern(*codes):
+    """只在上下文中匹配错误码（-412、HTTP 412、(412)、code: 412），避免误匹配时间戳的毫秒、文件大小和码率"""
+    code = '|'.join(codes)
+    return (rf'(?:(?<![\w.-])-(?:{code})|HTTP(?:/[\d.]+)?\s+(?:{code})|\((?:{code})\)|'
+            rf'(?:[Ss]tatus(?:\s*[Cc]ode)?|\bcode)"?\s*[:=]?\s*-?(?:{code}))(?!\d)')
+
+# 失败原因分类，按顺序匹配日志末尾（已去掉行首时间戳），先匹配到的为准
+FAILURE_PATTERNS = [
+    ('rate_limit', re.compile(status_code_pattern('412', '429') +
+                              r'|Precondition Failed|Too Many Requests|请求过于频繁|风控')),
+    ('auth', re.compile(status_code_pattern('101', '401') +
+                        r'|账号未登录|未登录|需要登录|登录后|大会员|Unauthorized|[Cc]ookie.{0,10}(?:无效|失效|过期)')),
+    ('not_found', re.compile(status_code_pattern('404') + r'|Not Found|啥都木有|视频不见了|稿件不可见|不存在')),
+    ('mux', re.compile(r'混流失败|[Mm]ux(?:ing)? (?:failed|error)|[Ff]fmpeg.{0,40}(?:error|失败|exited)|MP4Box.{0,40}(?:error|失败)')),
+    ('network', re.compile(r'[Tt]imed? ?out|超时|网络(?:错误|异常|不可用|连接失败)|Connection (?:reset|refused|closed)|'
+                           r'reset by peer|HttpRequestException|SocketException|SSL connection could not be established|'
+                           r'Name or service not known|No such host')),
+]
+FAILURE_LABELS = {
+    'rate_limit': '请求被限流(412)',
+    'auth': '登录状态或Cookie无效',
+    'not_found': '视频不存在或不可见',
+    'mux': '混流失败',
+    'network': '网络错误',
+    'unknown': '未知错误',
+}
+# 可以自动重试的失败类型
+TRANSIENT_FAILURES = ('network', 'rate_limit')
+# 重试等待时间（秒）：基数按失败类型区分，每次翻倍，不超过上限
+RETRY_BASE_DELAY = {'network': 5, 'rate_limit': 30}
+RETRY_MAX_DELAY = 600
+
+# 本服务写入日志时添加的"[HH:MM:SS] [LEVEL] "前缀
+SERVER_LOG_PREFIX_RE = re.compile(r'^\[\d{2}:\d{2}:\d{2}\] \[[A-Z]+\] ')
+
+def strip_log_prefixes(text):
+    """去掉每行本服务和BBDown添加的时间戳前缀"""
+    return '\n'.join(INFO_PREFIX_RE.sub('', SERVER_LOG_PREFIX_RE.sub('', line)) for line in text.splitlines())
+
+def classify_failure(log_tail):
+    """根据日志末尾判断失败原因"""
+    text = strip_log_prefixes(log_tail)
+    for kind, pattern in FAILURE_PATTERNS:
+        if pattern.search(text):
+            return kind
+    return 'unknown'
+
+def retry_delay(kind, attempt):
+    """第attempt次重试前的等待时间：指数退避，在后一半区间内随机抖动，避免同时重试"""
+    delay = min(RETRY_BASE_DELAY.get(kind, 5) * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def schedule_retry(task, kind):
+    """失败的任务进入retry_wait，到时间后重新排队；等待期间不占用工作槽位"""
+    task.retries += 1
+    delay = retry_delay(kind, task.retries)
+    task.append_log(format_log_line(
+        f"🔁 {delay:.0f} 秒后自动重试（第 {task.retries}/{app_settings['max_retries']} 次）"))
+    with download_lock:
+        task.retry_timer = threading.Timer(delay, requeue_task, (task,))
+        task.retry_timer.daemon = True
+        task.update(status='retry_wait', slot=None, retry_at=time.time() + delay)
+        task.retry_timer.start()
+
+def requeue_task(task):
+    with download_lock:
+        if task.status != 'retry_wait' or task.cancel_requested:
+            return
+        task.update(status='pending', retry_at=None)
+        task.queued_at = time.time()
+        download_queue.put(task)
+    event_bus.publish('queue-changed', {})
+
+def finish_crashed_task(task, process, stage_dir, error):
+    """处理任务时出现异常：结束进程、删除临时目录，按失败任务记入历史并参与内存回收"""
+    task.append_log(format_log_line(f"❌ 系统错误: {str(error)}"))
+    if process:
+        kill_process_tree(process)
+        try:
+            process.wait(CANCEL_KILL_TIMEOUT + 1)
+        except subprocess.TimeoutExpired:
+            pass
+        with download_lock:
+            task.process = None
+    if stage_dir:
+        remove_stage_dir(stage_dir)
+    task.end_stage()
+    if isinstance(error, FileNotFoundError):
+        toolchain.clear()  # BBDown可能已被移动或删除，下次重新查找
+    task.update(status="failed", slot=None)
+    record_history(task)
+    retire_finished_task(task)
+
+def download_worker(slot=0):
+    """后台下载线程，slot为该线程在线程池中的槽位编号"""
+    while True:
+        if worker_pool.retire(slot):
+            break
+        task = process = stage_dir = None
+        try:
+            task = download_queue.get(timeout=1)
+            if task is None:
+                worker_pool.retire(slot, force=True)
+                break
+            # 等待期间线程池被缩小：任务放回队列交给其他线程，本线程退出
+            if worker_pool.retire(slot):
+                download_queue.put_back(task)
+                break
+                
+            task.update(status="downloading", slot=slot)
+            download_status[task.id] = task
+            task.begin_stage('queue', start=task.queued_at)
+            
+            # 每个任务使用独立的临时目录，完成后再移动到目标目录
+            work_dir = os.path.expanduser(task.options.get('work_dir') or DEFAULT_WORK_DIR)
+            stage_dir = get_task_stage_dir(work_dir, task.id)
+            
+            # 构建BBDown命令
+            cmd = build_bbdown_command(task.url, task.options, stage_dir)
+            
             # 格式化命令显示
             cmd_display = ' '.join(cmd[:3]) + '...' if len(cmd) > 3 else ' '.join(cmd)
             
             # 添加初始日志，每行都确保有换行
-            task.log = format_log_line("========== 开始新的下载任务 ==========")
-            task.log += format_log_line(f"视频URL: {task.url}")
-            task.log += format_log_line(f"下载目录: {task.options.get('work_dir', DEFAULT_WORK_DIR)}")
-            task.log += format_log_line(f"执行命令: {cmd_display}")
-            task.log += format_log_line("========================================")
-            task.log += '\n'  # 额外的空行分隔
+            task.append_log(format_log_line("========== 开始新的下载任务 =========="))
+            task.append_log(format_log_line(f"视频URL: {task.url}"))
+            task.append_log(format_log_line(f"下载目录: {work_dir}"))
+            task.append_log(format_log_line(f"工作槽位: #{slot + 1}"))
+            if task.retries:
+                task.append_log(format_log_line(f"自动重试: 第 {task.retries} 次"))
+            task.append_log(format_log_line(f"执行命令: {cmd_display}"))
+            task.append_log(format_log_line("========================================"))
+            task.append_log('\n')  # 额外的空行分隔
             
-            # 执行下载
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
+            # 取出任务后、启动进程前被取消
+            if task.cancel_requested:
+                finish_cancelled_task(task)
+                continue
+            
+            # 执行下载，以原始字节流读取输出
+            output_start = task.log.end
+            task.begin_stage('startup')
+            process_started = time.time()
+            process = start_download_process(cmd, stage_dir)
+            with download_lock:
+                task.process = process
+                cancelled = task.cancel_requested
+            if cancelled:
+                kill_process_tree(process)
+            monitor = ResourceMonitor(task, process)
+            monitor.start()
             
             # 实时更新日志
-            for line in iter(process.stdout.readline, ''):
-                if line:
-                    # 去除原始换行，由format_log_line添加
-                    formatted_line = format_log_line(line.rstrip('\n\r'))
-                    task.log += formatted_line
-                    
-                    # 尝试解析进度
-                    progress_match = re.search(r'(\d+)%', line)
-                    if progress_match:
-                        task.progress = int(progress_match.group(1))
-                    
-                    # 尝试提取视频标题
-                    if '视频标题:' in line or 'Title:' in line:
-                        title_match = re.search(r'[视频标题|Title]:\s*(.+)', line)
-                        if title_match:
-                            task.title = title_match.group(1).strip()
+            logged_progress = None
+            tracker = ProgressTracker(task)
+            for line, redraw in iter_output_lines(process.stdout):
+                metrics.log_line()
+                # 一次扫描得到日志级别、进度和视频标题
+                level, progress, title = classify_log_line(line)
+                
+                if level == 'PROGRESS':
+                    tracker.feed(line, progress)
+                else:
+                    tracker.start_stream(line)
+                    stage = match_stage(line)
+                    if stage and stage[0] == 'done':
+                        task.end_stage()
+                    elif stage:
+                        task.begin_stage(*stage)
+                if title:
+                    task.update(title=title)
+                
+                # 进度条重绘的行只在百分比变化时写入日志
+                if redraw:
+                    if not line or line.isspace() or progress == logged_progress:
+                        continue
+                    logged_progress = progress
+                task.append_log(format_log_line(line, level))
+            
+            tracker.flush()
+            process.stdout.close()
+            monitor.wait()
+            # 服务器正在退出：进程是被关闭流程结束的，任务保持未完成状态，重启后重新下载
+            if shutting_down.is_set():
+                break
+            metrics.observe_stage('download', time.time() - process_started)
+            task.end_stage()
+            with download_lock:
+                task.process = None
+                cancelled = task.cancel_requested
             
-            process.wait()
+            # 把临时目录中的文件移动到下载目录，取消的任务直接丢弃
+            if process.returncode == 0 and not cancelled:
+                task.begin_stage('finalize')
+                merge_move_tree(stage_dir, work_dir, lambda message: task.append_log(format_log_line(message)))
+                task.end_stage()
+            remove_stage_dir(stage_dir)
+            
+            # 根据本次运行输出的末尾判断失败原因
+            failure = None
+            if process.returncode != 0 and not cancelled:
+                failure = classify_failure(task.log.read(max(output_start, task.log.end - 8192))[0])
             
             # 结束日志
-            task.log += '\n'  # 空行分隔
-            task.log += format_log_line("========================================")
-            if process.returncode == 0:
-                task.status = "completed"
-                task.progress = 100
-                task.log += format_log_line("✅ 下载任务完成！")
+            task.append_log('\n')  # 空行分隔
+            task.append_log(format_log_line("========================================"))
+            if cancelled:
+                task.append_log(format_log_line("⛔ 任务已取消"))
+            elif process.returncode == 0:
+                task.append_log(format_log_line("✅ 下载任务完成！"))
+            else:
+                task.append_log(format_log_line(
+                    f"❌ 下载失败，返回码: {process.returncode}，原因: {FAILURE_LABELS[failure]}"))
+            task.append_log(format_log_line("========== 任务结束 =========="))
+            task.append_log('\n')
+            
+            # 临时性错误在重试次数内自动重试，任务继续保持未结束状态
+            if failure in TRANSIENT_FAILURES and task.retries < app_settings['max_retries']:
+                task.update(failure=failure)
+                schedule_retry(task, failure)
+                continue
+            
+            # 日志写完后再更新状态，保证事件流在结束前收到全部日志
+            if cancelled:
+                task.update(status="cancelled", slot=None)
+            elif process.returncode == 0:
+                task.update(status="completed", progress=100, slot=None, failure=None)
             else:
-                task.status = "failed"
-                task.log += format_log_line(f"❌ 下载失败，返回码: {process.returncode}")
-            task.log += format_log_line("========== 任务结束 ==========")
-            task.log += '\n'
+                task.update(status="failed", slot=None, failure=failure)
                 
             # 保存到历史
-            download_history.append({
-                'title': task.title,
-                'url': task.url,
-                'time': task.start_time,
-                'status': task.status
-            })
+            record_history(task)
+            retire_finished_task(task)
             
         except queue.Empty:
             continue
         except Exception as e:
-            if 'task' in locals() and task:
-                task.status = "failed"
-                task.log += format_log_line(f"❌ 系统错误: {str(e)}")
+            if task:
+                finish_crashed_task(task, process, stage_dir, e)
+worker_pool = WorkerPool(download_worker)
 
-def build_bbdown_command(url, options):
-    """构建BBDown命令行参数"""
-    bbdown_path = os.path.expanduser(options.get('bbdown_path', app_settings['bbdown_path']))
-    
-    # 如果BBDown不存在，尝试直接使用BBDown命令
-    if not os.path.exists(bbdown_path):
-        bbdown_path = 'BBDown'
-    
+def build_bbdown_command(url, options, work_dir=None):
+    """构建BBDown命令行参数，work_dir用于覆盖任务选项中的下载目录"""
+    bbdown_path = toolchain.bbdown_executable(options.get('bbdown_path') or app_settings['bbdown_path'])
     cmd = [bbdown_path, url]
     
     # Cookie
@@ -1600,7 +3840,8 @@ def build_bbdown_command(url, options):
         cmd.extend(['-F', options['file_pattern']])
     
     # 工作目录 - 使用默认目录或用户指定的目录
-    work_dir = options.get('work_dir', DEFAULT_WORK_DIR)
+    if not work_dir:
+        work_dir = options.get('work_dir', DEFAULT_WORK_DIR)
     if not work_dir:
         work_dir = DEFAULT_WORK_DIR
     work_dir = os.path.expanduser(work_dir)
@@ -1609,9 +3850,137 @@ def build_bbdown_command(url, options):
     
     return cmd
 
+class StaticAsset:
+    """预先压缩好的静态内容，ETag取内容摘要，每种编码使用不同的ETag"""
+
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        self.digest = digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': (body, f'"{digest}"')}
+        self.variants['gzip'] = (gzip.compress(body, 9), f'"{digest}-gz"')
+        if brotli:
+            self.variants['br'] = (brotli.compress(body), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def response(self, cache_control):
+        """按If-None-Match返回304，否则按Accept-Encoding选择压缩格式"""
+        headers = {'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        encoding = request.accept_encodings.best_match(list(self.variants), default='identity')
+        body, etag = self.variants[encoding]
+        headers['ETag'] = etag
+        if any(request.if_none_match.contains_raw(tag) for tag in self.etags):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(body, content_type=self.content_type, headers=headers)
+
+# 文件名带内容摘要的静态资源，内容变化时文件名也变化，可以长期缓存
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PAGE_STYLE_RE = re.compile(r'<style>(.*?)</style>', re.S)
+PAGE_SCRIPT_RE = re.compile(r'<script>(.*?)</script>', re.S)
+
+_index_asset = None
+page_assets = {}
+_page_lock = threading.Lock()
+
+def get_index_asset():
+    """首页只渲染一次：样式和脚本拆成带摘要的独立资源，页面和资源都预先压缩"""
+    global _index_asset
+    with _page_lock:
+        if _index_asset is None:
+            with app.app_context():
+                html = render_template_string(HTML_TEMPLATE)
+            
+            def extract(match, extension, content_type, tag):
+                asset = StaticAsset(match.group(1).encode('utf-8'), content_type)
+                name = f"app.{asset.digest}.{extension}"
+                page_assets[name] = asset
+                return tag.format(url=f"/assets/{name}")
+            
+            html = PAGE_STYLE_RE.sub(lambda m: extract(m, 'css', 'text/css; charset=utf-8',
+                                                       '<link rel="stylesheet" href="{url}">'), html, count=1)
+            html = PAGE_SCRIPT_RE.sub(lambda m: extract(m, 'js', 'application/javascript; charset=utf-8',
+                                                        '<script src="{url}"></script>'), html, count=1)
+            _index_asset = StaticAsset(html.encode('utf-8'), 'text/html; charset=utf-8')
+        return _index_asset
+
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # 页面本身每次用ETag确认，未变化时只返回304
+    return get_index_asset().response('no-cache')
+
+@app.route("/assets/<name>", methods=["GET"])
+def page_asset(name):
+    get_index_asset()
+    asset = page_assets.get(name)
+    if not asset:
+        return Response(status=404)
+    return asset.response(ASSET_CACHE_CONTROL)
+
+_last_task_ms = 0
+
+def new_task_id():
+    """生成任务ID，同一毫秒内的多个任务顺延到下一毫秒，保证不重复"""
+    global _last_task_ms
+    with download_lock:
+        _last_task_ms = max(int(time.time() * 1000), _last_task_ms + 1)
+        return f"task_{_last_task_ms}"
+
+def register_task(task):
+    """登记新任务并放入下载队列"""
+    register_tasks([task])
+
+def register_tasks(tasks):
+    """在一次加锁中登记多个任务并放入下载队列"""
+    with download_lock:
+        for task in tasks:
+            download_status[task.id] = task
+            active_downloads.setdefault(task.video_key, task)
+            download_queue.put(task)
+            metrics.task_state(None, task.status)
+    for task in tasks:
+        if task_store:
+            task_store.save_task(task)
+        event_bus.publish('task-created', task.to_dict())
+
+def build_task_options(data):
+    """合并请求中的下载选项和全局设置"""
+    options = dict(data)
+    for key in ['bbdown_path', 'ffmpeg_path', 'mp4box_path', 'user_agent', 'upos_host', 'debug']:
+        if key not in options or not options[key]:
+            options[key] = app_settings.get(key, '')
+    
+    # 设置默认下载目录
+    if not options.get('work_dir') or options['work_dir'].strip() == '':
+        options['work_dir'] = app_settings['default_dir']
+    return options
+
+def submit_downloads(urls, options, force=False):
+    """提交下载：已下载过的跳过（force时重新下载），与进行中任务相同的直接关联到该任务
+
+    返回与urls一一对应的(结果, 任务ID, 说明)，结果为created/attached/downloaded
+    """
+    download_index.refresh(app_settings['default_dir'])
+    results = []
+    tasks = []
+    with download_lock:
+        for url in urls:
+            video_key = download_key(url, options)
+            running = active_downloads.get(video_key)
+            if running:
+                results.append(('attached', running.id, running.title))
+                continue
+            done = None if force else download_index.lookup(video_key)
+            if done:
+                results.append(('downloaded', done['task_id'], done['title']))
+                continue
+            task = DownloadTask(new_task_id(), url, dict(options))
+            # 同一批中的重复项也能关联到刚创建的任务
+            active_downloads[video_key] = task
+            tasks.append(task)
+            results.append(('created', task.id, task.title))
+        register_tasks(tasks)
+    return results
 
 @app.route("/api/download", methods=["POST"])
 def api_download():
@@ -1622,31 +3991,306 @@ def api_download():
         if not url:
             return jsonify({'success': False, 'message': '请输入视频地址'})
         
-        # 从文本中提取URL
-        url = extract_url_from_text(url)
+        # 从文本中提取URL，短链接展开为实际地址
+        url = short_link_resolver.resolve(extract_url_from_text(url))
         
-        # 创建下载任务
-        task_id = f"task_{int(time.time() * 1000)}"
+        # 创建下载任务并添加到队列
+        force = bool(data.pop('force', False))
+        result, task_id, title = submit_downloads([url], build_task_options(data), force)[0]
         
-        # 合并全局设置
-        for key in ['bbdown_path', 'ffmpeg_path', 'mp4box_path', 'user_agent', 'upos_host', 'debug']:
-            if key not in data or not data[key]:
-                data[key] = app_settings.get(key, '')
+        if result == 'attached':
+            message = '相同的下载任务正在进行，已关联到该任务'
+        elif result == 'downloaded':
+            message = f'该视频已下载过（{title}），勾选"重新下载已有视频"可再次下载'
+        else:
+            message = '下载任务已添加到队列'
+        return jsonify({
+            'success': True,
+            'task_id': task_id,
+            'attached': result == 'attached',
+            'downloaded': result == 'downloaded',
+            'message': message
+        })
         
-        # 设置默认下载目录
-        if not data.get('work_dir') or data['work_dir'].strip() == '':
-            data['work_dir'] = app_settings['default_dir']
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+# 解析结果缓存的有效期（秒）和条目上限
+PARSE_CACHE_TTL = 600
+PARSE_CACHE_SIZE = 256
+
+class ParseCache:
+    """解析结果缓存
+
+    条目带有效期，超出容量时淘汰最久未使用的；同一个键的并发请求
+    只有第一个真正执行，其余等待并共享它的结果（single-flight）。
+    """
+
+    def __init__(self, ttl=PARSE_CACHE_TTL, max_entries=PARSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """返回(结果, 是否来自缓存或其他请求)，compute返回(是否可缓存, 结果)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                return entry[1], True
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = {'done': threading.Event(), 'result': None, 'error': None}
         
-        task = DownloadTask(task_id, url, data)
+        if not leader:
+            call['done'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result'], True
         
-        # 添加到队列
-        download_queue.put(task)
-        download_status[task_id] = task
+        try:
+            cacheable, call['result'] = compute()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+                if call['error'] is None and cacheable:
+                    self.entries[key] = (time.time() + self.ttl, call['result'])
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+            call['done'].set()
+        return call['result'], False
+
+    def peek(self, key):
+        """只查缓存，不触发计算"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                return entry[1]
+            return None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+parse_cache = ParseCache()
+
+def parse_cache_key(url, cookie):
+    """缓存键：规范化的视频ID + Cookie摘要 + 影响输出的设置"""
+    cookie_id = hashlib.sha256(cookie.encode('utf-8')).hexdigest()[:16] if cookie else ''
+    return (canonical_video_key(url), cookie_id, bool(app_settings.get('enable_debug')))
+
+# BBDown信息输出的解析规则
+INFO_PREFIX_RE = re.compile(r'^\[\d{4}-\d{2}-\d{2} [\d:.]+\]\s*-\s*')
+INFO_PAGE_RE = re.compile(r'^P(\d+):\s*\[(\d*)\]\s*\[(.*)\]\s*\[((?:\d+h)?(?:\d+m)?(?:\d+s)?)\]')
+INFO_STREAM_SECTION_RE = re.compile(r'共计\s*(\d+)\s*条(视频|音频)流')
+INFO_STREAM_RE = re.compile(r'^(\d+)\.\s*((?:\[[^\]]*\]\s*)+)$')
+INFO_DURATION_RE = re.compile(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?')
+INFO_RESOLUTION_RE = re.compile(r'^\d+x\d+$')
+INFO_NUMBER_RE = re.compile(r'^\d+(?:\.\d+)?$')
+INFO_SIZE_RE = re.compile(r'~?\s*' + SIZE_PATTERN)
+
+def parse_duration(text):
+    hours, minutes, seconds = (int(value or 0) for value in INFO_DURATION_RE.fullmatch(text).groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+def parse_stream_fields(fields, kind):
+    """把"[1080P 高清] [1920x1080] [AVC] [30] [2000 kbps] [~80.5 MB]"这样的字段按内容归类"""
+    stream = {}
+    rest = []
+    for field in fields:
+        if field.endswith('kbps'):
+            stream['bitrate_kbps'] = int(float(field.split()[0]))
+        elif field.startswith('~'):
+            stream['size'] = field[1:].strip()
+            size = INFO_SIZE_RE.fullmatch(field)
+            if size:
+                stream['size_bytes'] = parse_size(size.group(1), size.group(2))
+        elif INFO_RESOLUTION_RE.match(field):
+            stream['resolution'] = field
+        elif INFO_NUMBER_RE.match(field):
+            stream['fps'] = float(field)
+        else:
+            rest.append(field)
+    # 视频流剩下的依次是清晰度和编码，音频流只有编码
+    if kind == 'video' and len(rest) > 1:
+        stream['quality'] = rest.pop(0)
+    if rest:
+        stream['codec'] = rest[0]
+    return stream
+
+def parse_bbdown_info(output, url=''):
+    """把BBDown --only-show-info的输出整理成结构化数据"""
+    video = {
+        'id': canonical_video_key(url),
+        'title': None,
+        'aid': None,
+        'bvid': None,
+        'pubdate': None,
+        'pages': [],
+        'video_streams': [],
+        'audio_streams': []
+    }
+    match = VIDEO_ID_RE.search(url)
+    if match and match.group(1):
+        video['bvid'] = match.group(1)
+    elif match and match.group(2).lower() == 'av':
+        video['aid'] = match.group(3)
+    section = None
+    for raw_line in output.split('\n'):
+        line = INFO_PREFIX_RE.sub('', raw_line.strip())
+        if not line:
+            continue
+        if line.startswith('视频标题:'):
+            video['title'] = line.split(':', 1)[1].strip()
+        elif line.startswith('获取aid结束:'):
+            video['aid'] = line.split(':', 1)[1].strip()
+        elif line.startswith('发布时间:'):
+            video['pubdate'] = line.split(':', 1)[1].strip()
+        elif INFO_STREAM_SECTION_RE.search(line):
+            section = 'audio' if '音频' in line else 'video'
+        else:
+            page = INFO_PAGE_RE.match(line)
+            stream = INFO_STREAM_RE.match(line)
+            if page:
+                video['pages'].append({
+                    'index': int(page.group(1)),
+                    'cid': page.group(2),
+                    'title': page.group(3),
+                    'duration': page.group(4),
+                    'duration_seconds': parse_duration(page.group(4))
+                })
+            elif stream and section:
+                fields = re.findall(r'\[([^\]]*)\]', stream.group(2))
+                item = parse_stream_fields(fields, section)
+                item['index'] = int(stream.group(1))
+                video[f"{section}_streams"].append(item)
+    # av号和番剧链接没有BV号，由aid换算
+    if not video['bvid'] and video['aid'] and video['aid'].isdigit():
+        video['bvid'] = av_to_bv(int(video['aid']))
+    return video
+
+def run_parse(url, cookie):
+    """运行BBDown --only-show-info，返回(是否可缓存, 响应数据)"""
+    bbdown_path = toolchain.bbdown_executable(app_settings['bbdown_path'])
+    cmd = [bbdown_path, url, '--only-show-info']
+    
+    if cookie:
+        cmd.extend(['-c', cookie])
+    
+    # 添加调试选项
+    if app_settings.get('enable_debug'):
+        cmd.append('--debug')
+    
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    except subprocess.TimeoutExpired:
+        return False, {'success': False, 'message': '解析超时'}
+    
+    if result.returncode == 0:
+        formatted_output = ""
+        for line in result.stdout.split('\n'):
+            if line.strip():
+                formatted_output += format_log_line(line.strip())
+        return True, {
+            'success': True,
+            'info': formatted_output,
+            'video': parse_bbdown_info(result.stdout, url)
+        }
+    else:
+        error_msg = result.stderr if result.stderr else result.stdout
+        return False, {'success': False, 'message': error_msg}
+
+# 解析任务保留的时间（秒）和并发解析的进程数
+PARSE_JOB_TTL = 600
+PARSE_JOB_WORKERS = 4
+
+class ParseJob:
+    """后台运行的解析任务"""
+
+    def __init__(self, key):
+        self.id = f"parse_{uuid.uuid4().hex[:12]}"
+        self.key = key
+        self.status = 'running'
+        self.result = None
+        self.cached = False
+        self.created_at = time.time()
+        self.done = threading.Event()
+
+    def to_dict(self):
+        data = {'success': True, 'job_id': self.id, 'status': self.status}
+        if self.result is not None:
+            data.update(self.result)
+            data['cached'] = self.cached
+        return data
+
+parse_jobs = {}
+parse_jobs_lock = threading.Lock()
+parse_executor = ThreadPoolExecutor(max_workers=PARSE_JOB_WORKERS, thread_name_prefix='parse')
+
+def run_parse_job(job, url, cookie):
+    try:
+        job.result, job.cached = parse_cache.get_or_compute(job.key, lambda: run_parse(url, cookie))
+    except Exception as e:
+        job.result = {'success': False, 'message': str(e)}
+    job.status = 'done'
+    job.done.set()
+
+def submit_parse_job(url, cookie):
+    """提交解析任务；缓存命中时直接完成，相同的进行中任务直接复用"""
+    key = parse_cache_key(url, cookie)
+    with parse_jobs_lock:
+        # 清理过期的任务
+        expired = time.time() - PARSE_JOB_TTL
+        for job_id in [job_id for job_id, job in parse_jobs.items() if job.created_at < expired]:
+            del parse_jobs[job_id]
+        
+        for job in parse_jobs.values():
+            if job.key == key and job.status == 'running':
+                return job
+        job = ParseJob(key)
+        parse_jobs[job.id] = job
+    
+    cached = parse_cache.peek(key)
+    if cached is not None:
+        job.result, job.cached, job.status = cached, True, 'done'
+        job.done.set()
+    else:
+        parse_executor.submit(run_parse_job, job, url, cookie)
+    return job
+
+@app.route("/api/download/batch", methods=["POST"])
+def api_download_batch():
+    """批量添加下载任务：从文本中提取所有视频地址，去重后一次性加入队列"""
+    try:
+        data = request.json
+        text = data.pop('urls', '') or ''
+        
+        # 短链接展开后可能与其他地址指向同一个视频，需要再去重一次
+        urls = unique_video_urls(resolve_video_urls(extract_urls_from_text(text)))
+        if not urls:
+            return jsonify({'success': False, 'message': '没有识别到视频地址'})
+        
+        force = bool(data.pop('force', False))
+        results = submit_downloads(urls, build_task_options(data), force)
+        task_ids = [task_id for result, task_id, _ in results if result == 'created']
+        attached = sum(1 for result, _, _ in results if result == 'attached')
+        downloaded = sum(1 for result, _, _ in results if result == 'downloaded')
         
         return jsonify({
             'success': True,
-            'task_id': task_id,
-            'message': '下载任务已添加到队列'
+            'task_ids': task_ids,
+            'count': len(task_ids),
+            'duplicates': len(URL_TOKEN_RE.findall(text)) - len(urls),
+            'attached': attached,
+            'downloaded': downloaded,
+            'message': f'已添加 {len(task_ids)} 个下载任务'
         })
         
     except Exception as e:
@@ -1654,6 +4298,7 @@ def api_download():
 
 @app.route("/api/parse", methods=["POST"])
 def api_parse():
+    """提交解析任务，立即返回任务ID，结果通过/api/parse/<job_id>获取"""
     try:
         data = request.json
         url = data.get('url', '').strip()
@@ -1661,80 +4306,373 @@ def api_parse():
         if not url:
             return jsonify({'success': False, 'message': '请输入视频地址'})
         
-        # 从文本中提取URL
-        url = extract_url_from_text(url)
-        
-        bbdown_path = os.path.expanduser(app_settings['bbdown_path'])
-        if not os.path.exists(bbdown_path):
-            bbdown_path = 'BBDown'
-            
-        cmd = [bbdown_path, url, '--only-show-info']
-        
-        if data.get('cookie'):
-            cookie = data['cookie'].strip()
-            if cookie:
-                cmd.extend(['-c', cookie])
-        
-        # 添加调试选项
-        if app_settings.get('enable_debug'):
-            cmd.append('--debug')
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        # 从文本中提取URL，短链接展开为实际地址
+        url = short_link_resolver.resolve(extract_url_from_text(url))
+        cookie = (data.get('cookie') or '').strip()
         
-        if result.returncode == 0:
-            formatted_output = ""
-            for line in result.stdout.split('\n'):
-                if line.strip():
-                    formatted_output += format_log_line(line.strip())
-            return jsonify({'success': True, 'info': formatted_output})
-        else:
-            error_msg = result.stderr if result.stderr else result.stdout
-            return jsonify({'success': False, 'message': error_msg})
+        job = submit_parse_job(url, cookie)
+        return jsonify(job.to_dict())
             
-    except subprocess.TimeoutExpired:
-        return jsonify({'success': False, 'message': '解析超时'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route("/api/parse/<job_id>", methods=["GET"])
+def api_parse_job(job_id):
+    """查询解析任务，带wait参数时最多等待该秒数直到任务完成"""
+    with parse_jobs_lock:
+        job = parse_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'status': 'not_found', 'message': '解析任务不存在'})
+    wait = request.args.get('wait', 0, type=float)
+    if wait > 0:
+        job.done.wait(min(wait, 25))
+    return jsonify(job.to_dict())
+
+def control_task(task_id, handler):
+    task = download_status.get(task_id)
+    if not task:
+        return jsonify({'success': False, 'message': '任务不存在或已结束'})
+    success, message = handler(task)
+    return jsonify({'success': success, 'status': task.status, 'message': message})
+
+@app.route("/api/task/<task_id>/cancel", methods=["POST"])
+def api_task_cancel(task_id):
+    """取消任务：排队中的直接移除，下载中的结束整个进程组"""
+    return control_task(task_id, cancel_task)
+
+@app.route("/api/task/<task_id>/pause", methods=["POST"])
+def api_task_pause(task_id):
+    return control_task(task_id, pause_task)
+
+@app.route("/api/task/<task_id>/resume", methods=["POST"])
+def api_task_resume(task_id):
+    return control_task(task_id, resume_task)
+
+@app.route("/api/queue", methods=["GET"])
+def api_queue():
+    """按下载顺序返回排队中的任务"""
+    limit = max(request.args.get('limit', 50, type=int), 1)
+    tasks = download_queue.snapshot(limit)
+    return jsonify({
+        'success': True,
+        'length': download_queue.qsize(),
+        'tasks': [{'id': task.id, 'title': task.title, 'url': task.url, 'priority': task.priority,
+                   'queue_position': position} for position, task in enumerate(tasks)]
+    })
+
+@app.route("/api/task/<task_id>/priority", methods=["POST"])
+def api_task_priority(task_id):
+    """修改排队中任务的优先级"""
+    try:
+        priority = int((request.json or {}).get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '优先级必须是整数'})
+    task = download_status.get(task_id)
+    if not task:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    if not download_queue.set_priority(task, priority):
+        return jsonify({'success': False, 'message': '只能调整排队中的任务'})
+    task.update(priority=priority)
+    event_bus.publish('queue-changed', {})
+    return jsonify({'success': True, 'priority': priority, 'queue_position': download_queue.position(task)})
+
+@app.route("/api/task/<task_id>/move-to-front", methods=["POST"])
+def api_task_move_to_front(task_id):
+    """把排队中的任务移到队首"""
+    task = download_status.get(task_id)
+    if not task:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    priority = download_queue.move_to_front(task)
+    if priority is None:
+        return jsonify({'success': False, 'message': '只能调整排队中的任务'})
+    task.update(priority=priority)
+    event_bus.publish('queue-changed', {})
+    return jsonify({'success': True, 'priority': priority, 'queue_position': 0, 'message': '已移到队首'})
+
+@app.route("/api/queue/reorder", methods=["POST"])
+def api_queue_reorder():
+    """按给定顺序重排排队中的任务，这些任务占据的位置不变"""
+    task_ids = (request.json or {}).get('task_ids') or []
+    if not isinstance(task_ids, list):
+        return jsonify({'success': False, 'message': 'task_ids必须是列表'})
+    priorities = download_queue.reorder(task_ids)
+    for task_id, priority in priorities.items():
+        task = download_status.get(task_id)
+        if task:
+            task.update(priority=priority)
+    event_bus.publish('queue-changed', {})
+    return jsonify({'success': True, 'count': len(priorities)})
+
+# 超过这个大小（字节）的JSON响应使用gzip压缩
+GZIP_MIN_SIZE = 1024
+
+def conditional_json(etag, build):
+    """带弱ETag的JSON响应：If-None-Match匹配时直接返回304，不调用build()生成内容"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.after_request
+def compress_response(response):
+    """压缩较大的JSON响应，事件流等流式响应不处理"""
+    if (response.mimetype != 'application/json' or response.status_code != 200
+            or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or request.accept_encodings['gzip'] <= 0):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, 6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def api_metrics():
+    """Prometheus格式的运行指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
-    tasks = []
-    for task_id, task in list(download_status.items())[-10:]:  # 只显示最近10个任务
-        tasks.append({
-            'id': task.id,
-            'url': task.url,
-            'title': task.title,
-            'status': task.status,
-            'start_time': task.start_time,
-            'progress': task.progress
-        })
-    return jsonify({'tasks': tasks[::-1]})  # 倒序显示，最新的在前
+    etag = f"{SERVER_INSTANCE}-s{event_bus.seq}.{registry_version.value}.{worker_pool.size}"
+    return conditional_json(etag, build_status_payload)
+
+def build_status_payload():
+    """最近任务的状态快照，供/api/status和事件流的snapshot使用"""
+    with download_lock:
+        recent = list(download_status.values())[-10:]  # 只显示最近10个任务
+    tasks = [task.to_dict() for task in recent]
+    workers = {
+        'size': worker_pool.size,
+        'busy': worker_pool.busy_slots()
+    }
+    return {'tasks': tasks[::-1], 'workers': workers, 'queue': {'length': download_queue.qsize()}}  # 倒序显示，最新的在前
 
 @app.route("/api/task/<task_id>/log", methods=["GET"])
 def api_task_log(task_id):
+    # 带since参数时只返回该偏移量之后的新日志
+    since = request.args.get('since', type=int)
     task = download_status.get(task_id)
     if task:
+        touch_finished_task(task_id)
+        log, offset, truncated = read_log(task.log, since)
         return jsonify({
-            'log': task.log[-20000:],  # 限制日志长度
+            'log': log,
+            'offset': offset,
+            'truncated': truncated,
             'status': task.status,
-            'progress': task.progress
+            'progress': task.progress,
+            'stream': task.stream,
+            'transfer': task.transfer,
+            'timeline': task.timeline
+        })
+    
+    # 已移出内存的任务从磁盘读取日志
+    spilled = load_spilled_log(task_id)
+    if spilled:
+        meta, log_buffer = spilled
+        log, offset, truncated = read_log(log_buffer, since)
+        return jsonify({
+            'log': log,
+            'offset': offset,
+            'truncated': truncated,
+            'status': meta['status'],
+            'progress': meta['progress'],
+            'timeline': meta.get('timeline', [])
         })
     return jsonify({'log': '', 'status': 'not_found'})
 
+def read_log(log_buffer, since):
+    if since is None:
+        return log_buffer.tail(20000)  # 限制日志长度
+    return log_buffer.read(since)
+
+# 事件流没有新数据时发送心跳的间隔（秒）
+SSE_KEEPALIVE_SECONDS = 15
+
+def format_sse(event, data, event_id=None):
+    """格式化一条Server-Sent Events消息"""
+    message = ''
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event}\n"
+    message += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return message
+
+# 单个事件流连接的最长时间（秒），到时结束响应，浏览器会带上Last-Event-ID自动重连
+SSE_MAX_LIFETIME = 300
+# 同时打开的事件流数量上限，serve()按线程数调整
+DEFAULT_MAX_EVENT_STREAMS = 16
+
+class EventStreamLimiter:
+    """限制同时打开的事件流数量
+
+    waitress中每个事件流在连接期间一直占用一个工作线程，不加限制时打开的页面多了
+    会占满所有线程，普通请求全部卡住。超出上限的连接返回503，页面退回轮询。
+    """
+
+    def __init__(self, limit=DEFAULT_MAX_EVENT_STREAMS):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+event_streams = EventStreamLimiter()
+
+class EventStream:
+    """包装事件流生成器：超过SSE_MAX_LIFETIME后结束，关闭时归还占用的名额
+
+    WSGI服务器在响应结束或客户端断开后调用close()，即使生成器从未开始执行也会调用，
+    所以名额在close()中归还，而不是依赖生成器内的finally。
+    """
+
+    def __init__(self, generator, lifetime=SSE_MAX_LIFETIME):
+        self.generator = generator
+        self.deadline = time.time() + lifetime
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # 生成器至少每SSE_KEEPALIVE_SECONDS产出一次，到期后在下一次产出时结束
+        if time.time() >= self.deadline:
+            raise StopIteration
+        return next(self.generator)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.generator.close()
+        event_streams.release()
+
+def sse_response(generator):
+    if not event_streams.acquire():
+        generator.close()
+        response = jsonify({'success': False, 'message': '事件流连接数已满，请使用轮询接口'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '60'
+        return response
+    return Response(EventStream(generator), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route("/api/task/<task_id>/stream", methods=["GET"])
+def api_task_stream(task_id):
+    """以SSE推送任务的新日志、进度和状态变化，事件ID为日志偏移量，断线后可用Last-Event-ID续传"""
+    task = download_status.get(task_id)
+    if not task:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        offset = since
+        if offset is None:
+            # 没有续传位置时先发送日志末尾部分
+            text, offset, _ = task.log.tail(20000)
+            yield format_sse('log', {'text': text, 'offset': offset, 'reset': True}, offset)
+        last_progress = None
+        last_transfer = None
+        last_status = None
+        last_timeline = None
+        while True:
+            version = task.version
+            text, offset, truncated = task.log.read(offset)
+            if text or truncated:
+                yield format_sse('log', {'text': text, 'offset': offset, 'reset': truncated}, offset)
+            if task.progress != last_progress or task.transfer is not last_transfer:
+                last_progress = task.progress
+                last_transfer = task.transfer
+                yield format_sse('progress', {
+                    'progress': last_progress,
+                    'stream': task.stream,
+                    'transfer': last_transfer
+                }, offset)
+            if task.timeline is not last_timeline:
+                last_timeline = task.timeline
+                yield format_sse('stage', {'timeline': last_timeline}, offset)
+            if task.status != last_status:
+                last_status = task.status
+                yield format_sse('status', {'status': last_status, 'title': task.title}, offset)
+            if last_status in FINISHED_STATUSES and task.log.end == offset:
+                yield format_sse('end', {'status': last_status}, offset)
+                return
+            if task.wait_for_change(version, SSE_KEEPALIVE_SECONDS) == version:
+                yield ': keepalive\n\n'
+    
+    return sse_response(generate())
+
+@app.route("/api/events", methods=["GET"])
+def api_events():
+    """所有任务的事件流：连接时先发送snapshot，之后推送任务的创建、进度和结束等变化"""
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        seq = last_event_id
+        events = event_bus.since(seq) if seq is not None else None
+        while True:
+            if events is None:
+                # 首次连接或错过的事件已被丢弃，发送完整快照
+                seq = event_bus.seq
+                yield format_sse('snapshot', build_status_payload(), seq)
+            else:
+                for seq, event, data in events:
+                    yield format_sse(event, data, seq)
+            if event_bus.wait(seq, SSE_KEEPALIVE_SECONDS) == seq:
+                yield ': keepalive\n\n'
+                events = []
+            else:
+                events = event_bus.since(seq)
+    
+    return sse_response(generate())
+
 @app.route("/api/history", methods=["GET"])
 def api_history():
     # 返回最近50条，倒序
-    return jsonify({'history': download_history[-50:][::-1]})
+    return conditional_json(f"{SERVER_INSTANCE}-h{history_version.value}",
+                            lambda: {'history': download_history[-50:][::-1]})
 
 @app.route("/api/history/clear", methods=["POST"])
 def api_clear_history():
     global download_history
     download_history = []
+    if task_store:
+        task_store.clear_history()
+    # 已下载索引中来自历史的部分一并清空，下载目录中的文件仍会被识别
+    download_index.clear_history()
+    # 历史清空后转存的日志也不再需要
+    shutil.rmtree(os.path.join(DATA_DIR, 'logs'), ignore_errors=True)
+    with download_lock:
+        spilled_log_cache.clear()
+    history_version.bump()
     return jsonify({'success': True, 'message': '历史已清空'})
 
 @app.route("/api/settings", methods=["GET"])
 def api_get_settings():
-    return jsonify({'success': True, 'settings': app_settings})
+    return conditional_json(f"{SERVER_INSTANCE}-c{settings_version.value}",
+                            lambda: {'success': True, 'settings': app_settings})
 
 @app.route("/api/settings", methods=["POST"])
 def api_save_settings():
@@ -1748,6 +4686,28 @@ def api_save_settings():
             if key in settings:
                 app_settings[key] = settings[key]
         
+        if 'max_retries' in settings:
+            try:
+                app_settings['max_retries'] = max(int(settings['max_retries']), 0)
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'message': '重试次数必须是整数'})
+        
+        # 调整并行下载数
+        if 'max_workers' in settings:
+            try:
+                max_workers = int(settings['max_workers'])
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'message': '同时下载数必须是整数'})
+            app_settings['max_workers'] = worker_pool.resize(max_workers)
+        
+        if task_store:
+            task_store.save_settings(app_settings)
+        settings_version.bump()
+        
+        # BBDown路径等设置变化后旧的解析结果和工具检测结果不再可靠
+        parse_cache.clear()
+        toolchain.clear()
+        
         # 创建目录如果不存在
         if 'default_dir' in settings:
             dir_path = os.path.expanduser(settings['default_dir'])
@@ -1781,32 +4741,123 @@ def api_open_folder():
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+# BBDown的候选路径，按优先级排列，第一个是设置中的路径
+BBDOWN_FALLBACK_PATHS = ['BBDown', '/usr/local/bin/BBDown', '~/.dotnet/tools/BBDown']
+
+def resolve_executable(path):
+    """把路径解析为可执行文件的绝对路径：含目录的直接检查，否则在PATH中查找；找不到返回None"""
+    path = os.path.expanduser(path)
+    if os.path.dirname(path):
+        return os.path.abspath(path) if os.path.isfile(path) and os.access(path, os.X_OK) else None
+    return shutil.which(path)
+
+def parse_version(pattern):
+    """生成从版本输出中提取版本号的函数"""
+    def parse(output):
+        match = re.search(pattern, output)
+        return match.group(1) if match else 'Unknown'
+    return parse
+
+class Toolchain:
+    """工具检测和路径解析的缓存
+
+    检测结果按(可执行文件绝对路径, mtime, 参数)缓存，文件被替换或升级后自动重新检测；
+    设置修改后调用clear()清空。多个工具的检测并行执行。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.probes = {}
+        self.bbdown_paths = {}
+
+    def clear(self):
+        with self.lock:
+            self.probes.clear()
+            self.bbdown_paths.clear()
+
+    def probe(self, path, args, parse_output, timeout=2):
+        """运行工具的版本命令，返回{'installed', 'path', 'version'}"""
+        resolved = resolve_executable(path)
+        if not resolved:
+            return {'installed': False}
+        try:
+            key = (resolved, os.stat(resolved).st_mtime_ns, tuple(args))
+        except OSError:
+            return {'installed': False}
+        with self.lock:
+            cached = self.probes.get(key)
+        if cached:
+            return cached
+        
+        try:
+            result = subprocess.run([resolved] + args, capture_output=True, text=True, timeout=timeout)
+        except (OSError, subprocess.SubprocessError):
+            result = None
+        if result and result.returncode == 0:
+            info = {'installed': True, 'path': resolved, 'version': parse_output(result.stdout)}
+        else:
+            info = {'installed': False, 'path': resolved}
+        with self.lock:
+            self.probes[key] = info
+        return info
+
+    def probe_all(self, probes):
+        """并行执行多个检测，probes为{名称: (路径, 参数, 解析函数, 超时)}"""
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            futures = {name: executor.submit(self.probe, *args) for name, args in probes.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def find_bbdown(self):
+        """并行检测所有候选路径，返回优先级最高的可用BBDown"""
+        candidates = [app_settings['bbdown_path']] + BBDOWN_FALLBACK_PATHS
+        results = self.probe_all({index: (path, ['--version'], str.strip, 5)
+                                  for index, path in enumerate(candidates)})
+        for index in range(len(candidates)):
+            if results[index]['installed']:
+                return results[index]
+        return None
+
+    def bbdown_executable(self, configured):
+        """下载和解析使用的BBDown路径：设置的路径不存在时使用PATH中的BBDown
+
+        在PATH中查找的结果按(绝对路径, mtime)缓存，文件被删除或替换后重新查找；
+        没有找到时不缓存，之后安装的BBDown可以立即使用。
+        """
+        path = os.path.expanduser(configured)
+        if os.path.exists(path):
+            return path
+        with self.lock:
+            cached = self.bbdown_paths.get(configured)
+        if cached:
+            try:
+                if os.stat(cached[0]).st_mtime_ns == cached[1]:
+                    return cached[0]
+            except OSError:
+                pass
+        path = shutil.which('BBDown')
+        if not path:
+            return 'BBDown'
+        path = os.path.abspath(path)
+        try:
+            key = (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return path
+        with self.lock:
+            self.bbdown_paths[configured] = key
+        return path
+
+toolchain = Toolchain()
+
 @app.route("/api/check-bbdown", methods=["GET"])
 def api_check_bbdown():
     try:
-        bbdown_path = os.path.expanduser(app_settings['bbdown_path'])
-        
-        # 尝试多个可能的路径
-        paths_to_check = [
-            bbdown_path,
-            'BBDown',
-            '/usr/local/bin/BBDown',
-            '~/.dotnet/tools/BBDown'
-        ]
-        
-        for path in paths_to_check:
-            path = os.path.expanduser(path)
-            try:
-                result = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    return jsonify({
-                        'installed': True,
-                        'path': path,
-                        'version': result.stdout.strip()
-                    })
-            except:
-                continue
-        
+        result = toolchain.find_bbdown()
+        if result:
+            return jsonify({
+                'installed': True,
+                'path': result['path'],
+                'version': result['version']
+            })
         return jsonify({'installed': False, 'message': 'BBDown未找到'})
     except Exception as e:
         return jsonify({'installed': False, 'message': str(e)})
@@ -1814,70 +4865,111 @@ def api_check_bbdown():
 @app.route("/api/test-tools", methods=["GET"])
 def api_test_tools():
     """测试各个工具是否已安装"""
-    tools = {}
-    
-    # 测试FFmpeg
-    ffmpeg_path = app_settings.get('ffmpeg_path') or 'ffmpeg'
-    try:
-        result = subprocess.run([ffmpeg_path, '-version'], capture_output=True, text=True, timeout=2)
-        if result.returncode == 0:
-            version_match = re.search(r'ffmpeg version ([\d.]+)', result.stdout)
-            tools['FFmpeg'] = {
-                'installed': True,
-                'version': version_match.group(1) if version_match else 'Unknown'
-            }
-        else:
-            tools['FFmpeg'] = {'installed': False}
-    except:
-        tools['FFmpeg'] = {'installed': False}
-    
-    # 测试MP4Box
-    mp4box_path = app_settings.get('mp4box_path') or 'mp4box'
-    try:
-        result = subprocess.run([mp4box_path, '-version'], capture_output=True, text=True, timeout=2)
-        if result.returncode == 0:
-            tools['MP4Box'] = {'installed': True, 'version': 'Installed'}
-        else:
-            tools['MP4Box'] = {'installed': False}
-    except:
-        tools['MP4Box'] = {'installed': False}
-    
-    # 测试Aria2c
-    aria2c_path = app_settings.get('aria2c_path') or 'aria2c'
-    try:
-        result = subprocess.run([aria2c_path, '--version'], capture_output=True, text=True, timeout=2)
-        if result.returncode == 0:
-            version_match = re.search(r'aria2 version ([\d.]+)', result.stdout)
-            tools['Aria2c'] = {
-                'installed': True,
-                'version': version_match.group(1) if version_match else 'Unknown'
-            }
-        else:
-            tools['Aria2c'] = {'installed': False}
-    except:
-        tools['Aria2c'] = {'installed': False}
-    
+    tools = toolchain.probe_all({
+        'FFmpeg': (app_settings.get('ffmpeg_path') or 'ffmpeg', ['-version'],
+                   parse_version(r'ffmpeg version ([\d.]+)'), 2),
+        'MP4Box': (app_settings.get('mp4box_path') or 'mp4box', ['-version'], lambda output: 'Installed', 2),
+        'Aria2c': (app_settings.get('aria2c_path') or 'aria2c', ['--version'],
+                   parse_version(r'aria2 version ([\d.]+)'), 2),
+    })
+    for info in tools.values():
+        info.pop('path', None)
     return jsonify({'success': True, 'tools': tools})
 
+# 后台服务（数据库、下载线程）只能启动一次
+_services_started = False
+_services_lock = threading.Lock()
+
+def start_background_services():
+    """创建下载目录，恢复任务数据并启动下载线程池；重复调用时直接返回，结果为恢复的任务数"""
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return 0
+        _services_started = True
+        os.makedirs(os.path.expanduser(DEFAULT_WORK_DIR), exist_ok=True)
+        
+        # 恢复设置、历史和未完成的任务
+        restored_count = init_task_store()
+        # 在保存数据（init_task_store中注册）之前执行：atexit按注册的相反顺序调用
+        atexit.register(terminate_download_processes)
+        
+        # 启动下载工作线程池
+        worker_pool.resize(app_settings['max_workers'])
+        
+        # 预先渲染并压缩首页
+        get_index_asset()
+        return restored_count
+
+def create_app():
+    """供外部WSGI服务器使用，例如 waitress-serve --call bbdown_web:create_app
+
+    任务状态保存在进程内存中，只能以单进程（多线程）方式运行。
+    """
+    start_background_services()
+    return app
+
+def parse_args(argv=None):
+    """命令行参数，未指定时读取对应的环境变量"""
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='BBDown Web GUI')
+    parser.add_argument('--host', default=env('BBDOWN_WEB_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(env('BBDOWN_WEB_PORT', 5555)))
+    # 每个打开的页面通过事件流长期占用1~2个线程，线程数需要留出余量
+    parser.add_argument('--threads', type=int, default=int(env('BBDOWN_WEB_THREADS', 32)),
+                        help='处理请求的线程数')
+    parser.add_argument('--max-streams', type=int, default=int(env('BBDOWN_WEB_MAX_STREAMS', 0)),
+                        help='同时打开的事件流数量上限，超出的页面改为轮询；0为线程数的一半')
+    parser.add_argument('--channel-timeout', type=int, default=int(env('BBDOWN_WEB_CHANNEL_TIMEOUT', 120)),
+                        help='空闲keep-alive连接的超时时间（秒）')
+    parser.add_argument('--connection-limit', type=int, default=int(env('BBDOWN_WEB_CONNECTION_LIMIT', 200)),
+                        help='同时打开的连接数上限')
+    parser.add_argument('--dev', action='store_true', default=env('BBDOWN_WEB_DEV') == '1',
+                        help='使用Flask自带的开发服务器')
+    return parser.parse_args(argv)
+
+def handle_sigterm(signum, frame):
+    """把SIGTERM（如docker stop）转换成正常退出，atexit中的清理才会执行"""
+    sys.exit(0)
+
+def serve(args):
+    """优先使用waitress，没有安装时退回Flask开发服务器"""
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if not args.dev:
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            print("未安装waitress，使用Flask开发服务器（pip install waitress）")
+        else:
+            event_streams.limit = args.max_streams or max(args.threads // 2, 1)
+            print(f"服务器: waitress（{args.threads} 线程，最多 {event_streams.limit} 个事件流）")
+            # send_bytes=1：事件流的每条消息立即发送，不在缓冲区中等待
+            waitress_serve(app, host=args.host, port=args.port, threads=args.threads,
+                           channel_timeout=args.channel_timeout, connection_limit=args.connection_limit,
+                           send_bytes=1, asyncore_use_poll=True, ident='BBDown-Web')
+            return
+    if args.max_streams:
+        event_streams.limit = args.max_streams
+    app.run(host=args.host, port=args.port, debug=False, threaded=True)
+
 if __name__ == "__main__":
-    # 创建默认下载目录
-    os.makedirs(os.path.expanduser(DEFAULT_WORK_DIR), exist_ok=True)
-    
-    # 启动下载工作线程
-    worker_thread = threading.Thread(target=download_worker, daemon=True)
-    worker_thread.start()
+    args = parse_args()
+    restored_count = start_background_services()
     
     print("=" * 50)
     print(f"BBDown Web GUI v{APP_VERSION}")
     print("=" * 50)
     print("启动中...")
     print(f"默认下载目录: {DEFAULT_WORK_DIR}")
-    print("请访问 http://localhost:5555")
+    print(f"同时下载任务数: {worker_pool.size}")
+    print(f"数据目录: {DATA_DIR}")
+    if restored_count:
+        print(f"已恢复 {restored_count} 个未完成的任务")
+    print(f"请访问 http://localhost:{args.port}")
     print("按 Ctrl+C 退出")
     print("=" * 50)
     
-    # 启动Flask应用
     try:
-        app.run(host="0.0.0.0", port=5555, debug=False)
+        serve(args)
     except KeyboardInterrupt:
         print("\n正在退出...")
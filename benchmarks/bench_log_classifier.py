@@ -0,0 +1,92 @@
+"""日志分类微基准：对比旧版format_log_line + 两次re.search 与 单次扫描分类器
+
+用法:
+    python benchmarks/bench_log_classifier.py [行数]
+"""
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bbdown_web import classify_log_line, format_log_line  # noqa: E402
+
+SAMPLE_LINES = [
+    '[2024-01-01 12:00:00.000] - 获取aid...',
+    '[2024-01-01 12:00:00.000] - 获取aid结束: 170001',
+    '[2024-01-01 12:00:00.000] - 视频标题: 【测试】一个很长的视频标题用于基准测试',
+    '[2024-01-01 12:00:00.000] - 开始下载P1视频...',
+    '[##########          ]  52.31%   48.21MB/92.12MB 5.23MB/s',
+    '[###############     ]  75.02%   69.11MB/92.12MB 6.01MB/s',
+    '[2024-01-01 12:00:00.000] - [DEBUG] HttpClient GET https://api.bilibili.com/x/player/playurl',
+    '[2024-01-01 12:00:00.000] - 开始合并音视频...',
+    '[2024-01-01 12:00:00.000] - 警告: 没有找到字幕',
+    '[2024-01-01 12:00:00.000] - 任务完成',
+]
+
+
+def legacy_format_log_line(line):
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    if not line or line.strip() == '':
+        return '\n'
+    if any(keyword in line for keyword in ['错误', 'ERROR', 'Failed', 'failed']):
+        return f"[{timestamp}] [ERROR] {line}\n"
+    elif any(keyword in line for keyword in ['警告', 'WARNING', 'Warning']):
+        return f"[{timestamp}] [WARN] {line}\n"
+    elif any(keyword in line for keyword in ['成功', 'SUCCESS', 'Completed', '完成', '✅']):
+        return f"[{timestamp}] [SUCCESS] {line}\n"
+    elif any(keyword in line for keyword in ['调试', 'DEBUG', 'Debug']):
+        return f"[{timestamp}] [DEBUG] {line}\n"
+    elif '%' in line:
+        return f"[{timestamp}] [PROGRESS] {line}\n"
+    else:
+        return f"[{timestamp}] [INFO] {line}\n"
+
+
+def legacy_ingest(line):
+    """旧版download_worker对每一行所做的处理"""
+    formatted = legacy_format_log_line(line)
+    progress = None
+    title = None
+    progress_match = re.search(r'(\d+)%', line)
+    if progress_match:
+        progress = int(progress_match.group(1))
+    if '视频标题:' in line or 'Title:' in line:
+        title_match = re.search(r'[视频标题|Title]:\s*(.+)', line)
+        if title_match:
+            title = title_match.group(1).strip()
+    return formatted, progress, title
+
+
+def current_ingest(line):
+    level, progress, title = classify_log_line(line)
+    return format_log_line(line, level), progress, title
+
+
+def measure(func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lines = (SAMPLE_LINES * (count // len(SAMPLE_LINES) + 1))[:count]
+
+    # 预热一次，避免首次编译正则的开销计入结果
+    measure(legacy_ingest, lines[:1000])
+    measure(current_ingest, lines[:1000])
+
+    before = max(measure(legacy_ingest, lines) for _ in range(3))
+    after = max(measure(current_ingest, lines) for _ in range(3))
+    print(f"行数: {count}")
+    print(f"旧版:   {before:,.0f} 行/秒")
+    print(f"单次扫描: {after:,.0f} 行/秒")
+    print(f"提升:   {after / before:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
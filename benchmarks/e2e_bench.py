@@ -0,0 +1,211 @@
+"""端到端基准测试：用模拟BBDown（fake_bbdown.py）驱动完整的下载流程，统计服务器自身的开销
+
+启动一个使用临时数据目录的服务器，把bbdown_path指向模拟脚本，通过/api/download提交N个任务，
+同时有若干客户端轮询状态接口。任务全部结束后报告日志处理速率（行/秒）、服务器CPU时间、
+内存增长以及提交和轮询接口的延迟分位数。不需要网络，可以用来发现性能退化。
+模拟BBDown的输出量通过FAKE_BBDOWN_*环境变量调整，见fake_bbdown.py。
+
+用法:
+    python benchmarks/e2e_bench.py [--tasks 8] [--workers 4] [--clients 10] [--lines 2000]
+    python benchmarks/e2e_bench.py --url http://127.0.0.1:5555 --pid 12345
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from load_test import percentile, poller, start_server
+
+FAKE_BBDOWN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_bbdown.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def make_wrapper():
+    """生成调用fake_bbdown.py的可执行脚本，服务器会像调用BBDown一样直接执行它"""
+    path = os.path.join(tempfile.mkdtemp(prefix='bbdown-web-fake-'), 'BBDown')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_BBDOWN}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def request_json(url, path, data=None):
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(url + path, body, {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def read_metrics(url):
+    """读取/metrics，返回{'名称{标签}': 数值}"""
+    with urllib.request.urlopen(url + '/metrics', timeout=10) as response:
+        text = response.read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            values[name] = float(value)
+    return values
+
+
+def finished_count(values):
+    return sum(value for name, value in values.items() if name.startswith('bbdown_web_tasks_finished_total'))
+
+
+def process_usage(pid):
+    """从/proc读取进程的(CPU秒数, 常驻内存字节数)，不可用时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class UsageSampler:
+    """定期采样服务器进程的内存，记录峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            usage = process_usage(self.pid)
+            if usage:
+                self.peak_rss = max(self.peak_rss, usage[1])
+
+
+def submit_tasks(url, count, latencies, errors):
+    """并发提交count个不同的视频（av号各不相同），记录每次提交的延迟"""
+    def submit(index):
+        start = time.perf_counter()
+        try:
+            result = request_json(url, '/api/download', {'url': f'av{1000000 + index}', 'force': True})
+            if result.get('success'):
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(result.get('message'))
+        except OSError as e:
+            errors.append(type(e).__name__)
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def format_latencies(latencies):
+    if not latencies:
+        return '无'
+    latencies = sorted(latencies)
+    return '  '.join(f"p{pct}={percentile(latencies, pct) * 1000:.1f}"
+                     for pct in (50, 90, 99)) + f"  max={latencies[-1] * 1000:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='已运行服务的地址（需与本脚本在同一台机器），不指定则自动启动一个')
+    parser.add_argument('--pid', type=int, help='配合--url指定服务器进程号，用于统计CPU和内存')
+    parser.add_argument('--dev', action='store_true', help='自动启动时使用Flask开发服务器')
+    parser.add_argument('--threads', type=int, default=32, help='自动启动的服务器线程数')
+    parser.add_argument('--tasks', type=int, default=8, help='提交的任务数')
+    parser.add_argument('--workers', type=int, default=4, help='同时下载任务数')
+    parser.add_argument('--clients', type=int, default=10, help='轮询状态接口的客户端数')
+    parser.add_argument('--interval', type=float, default=0.2, help='每个客户端两次轮询的间隔（秒）')
+    parser.add_argument('--lines', type=int, help='每个视频流的进度行数（FAKE_BBDOWN_PROGRESS_LINES）')
+    parser.add_argument('--timeout', type=float, default=600, help='等待全部任务结束的最长时间（秒）')
+    args = parser.parse_args()
+
+    if args.lines is not None:
+        os.environ['FAKE_BBDOWN_PROGRESS_LINES'] = str(args.lines)
+    process = None
+    url = args.url
+    pid = args.pid
+    if not url:
+        process, url = start_server(args.dev, args.threads)
+        pid = process.pid
+    try:
+        request_json(url, '/api/settings', {'bbdown_path': make_wrapper(), 'max_workers': args.workers,
+                                            'max_retries': 0})
+        before = read_metrics(url)
+        usage_before = process_usage(pid) if pid else None
+        sampler = UsageSampler(pid) if usage_before else None
+        if sampler:
+            sampler.peak_rss = usage_before[1]
+            sampler.thread.start()
+
+        poll_latencies, poll_errors = [], []
+        stop = threading.Event()
+        pollers = [threading.Thread(target=poller, daemon=True,
+                                    args=(url, '/api/status', args.interval, stop, poll_latencies, poll_errors))
+                   for _ in range(args.clients)]
+        for thread in pollers:
+            thread.start()
+
+        started = time.perf_counter()
+        submit_latencies, submit_errors = [], []
+        submit_tasks(url, args.tasks, submit_latencies, submit_errors)
+        target = finished_count(before) + len(submit_latencies)
+        after = before
+        while time.perf_counter() - started < args.timeout:
+            after = read_metrics(url)
+            if finished_count(after) >= target:
+                break
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - started
+        usage_after = process_usage(pid) if pid else None
+
+        stop.set()
+        for thread in pollers:
+            thread.join(15)
+        if sampler:
+            sampler.stop.set()
+            sampler.thread.join()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    lines = delta('bbdown_web_log_lines_total')
+    finished = finished_count(after) - finished_count(before)
+    completed = delta('bbdown_web_tasks_finished_total{status="completed"}')
+    print(f"服务器: {url}{' (Flask开发服务器)' if args.dev and not args.url else ''}")
+    print(f"任务: {args.tasks}  同时下载: {args.workers}  轮询客户端: {args.clients}  "
+          f"每流进度行数: {os.environ.get('FAKE_BBDOWN_PROGRESS_LINES', '2000')}")
+    print(f"结束: {finished:.0f}/{len(submit_latencies)}（成功 {completed:.0f}）  提交失败: {len(submit_errors)}  "
+          f"耗时: {elapsed:.2f}s")
+    print(f"日志处理: {lines:,.0f} 行  {lines / elapsed:,.0f} 行/秒")
+    if usage_before and usage_after:
+        cpu = usage_after[0] - usage_before[0]
+        print(f"服务器CPU: {cpu:.2f}s（单核 {cpu / elapsed * 100:.0f}%）  "
+              f"每千行 {cpu / max(lines, 1) * 1000 * 1000:.1f}ms")
+        print(f"服务器内存(MB): 开始 {usage_before[1] / 1048576:.1f}  峰值 {sampler.peak_rss / 1048576:.1f}  "
+              f"结束 {usage_after[1] / 1048576:.1f}  增长 {(usage_after[1] - usage_before[1]) / 1048576:+.1f}")
+    else:
+        print("服务器CPU/内存: 不可用（需要Linux的/proc，或用--pid指定进程号）")
+    print(f"提交延迟(ms): {format_latencies(submit_latencies)}")
+    print(f"状态轮询延迟(ms): {format_latencies(poll_latencies)}  请求数: {len(poll_latencies)}  "
+          f"失败: {len(poll_errors)}")
+    for stage in ('queue', 'startup', 'video', 'audio', 'mux', 'finalize'):
+        count = delta(f'bbdown_web_stage_duration_seconds_count{{stage="{stage}"}}')
+        if count:
+            total = delta(f'bbdown_web_stage_duration_seconds_sum{{stage="{stage}"}}')
+            print(f"  阶段 {stage}: 平均 {total / count:.2f}s（{count:.0f} 次）")
+
+
+if __name__ == '__main__':
+    main()
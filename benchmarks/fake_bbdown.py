@@ -0,0 +1,118 @@
+"""模拟BBDown的脚本，供基准测试在没有网络的环境下驱动完整的下载流程
+
+按BBDown的格式输出获取信息、下载视频/音频（\\r重绘的进度条）、调试信息和合并音视频等日志，
+并在工作目录中写入指定大小的假视频文件。行为通过环境变量配置（由服务器进程继承）：
+
+    FAKE_BBDOWN_PARTS           分P数量，默认1
+    FAKE_BBDOWN_PROGRESS_LINES  每个视频/音频流的进度行数，默认2000
+    FAKE_BBDOWN_LINE_INTERVAL   两条进度行的间隔（秒），默认0.001
+    FAKE_BBDOWN_DEBUG_EVERY     每隔多少条进度行插入一条调试日志，0为不插入，默认50
+    FAKE_BBDOWN_FILE_SIZE       每个分P写入的文件大小（字节），默认1MB
+    FAKE_BBDOWN_MUX_SECONDS     合并音视频耗时（秒），默认0.2
+    FAKE_BBDOWN_FAIL_RATE       以412错误退出的概率，默认0
+
+用法（需要可执行的包装脚本时见e2e_bench.py）:
+    python benchmarks/fake_bbdown.py BV1xx411c7mD --work-dir /tmp/out
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+VERSION = '1.6.3+fake'
+
+
+def env_number(name, default, kind=float):
+    try:
+        return kind(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def log(message):
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    sys.stdout.write(f'[{timestamp}] - {message}\n')
+    sys.stdout.flush()
+
+
+def progress_bar(percent, downloaded, total, speed):
+    filled = int(percent / 5)
+    return (f"\r[{'#' * filled}{' ' * (20 - filled)}] {percent:6.2f}%  "
+            f"{downloaded / 1048576:.2f}MB/{total / 1048576:.2f}MB {speed / 1048576:.2f}MB/s")
+
+
+def download_stream(part, kind, lines, interval, debug_every, total):
+    log(f'开始下载P{part}{kind}...')
+    for index in range(1, lines + 1):
+        percent = index * 100 / lines
+        sys.stdout.write(progress_bar(percent, total * index // lines, total, random.uniform(4, 8) * 1048576))
+        sys.stdout.flush()
+        if debug_every and index % debug_every == 0:
+            sys.stdout.write('\n')
+            log(f'[DEBUG] HttpClient GET https://upos-sz-mirrorcos.bilivideo.com/ugc/{part}-{kind}.m4s '
+                f'Range: bytes={total * index // lines}-')
+        if interval:
+            time.sleep(interval)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
+def write_dummy_file(path, size):
+    chunk = b'\0' * min(size, 1048576)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining -= len(chunk)
+
+
+def main(argv):
+    if '--version' in argv or '-v' in argv:
+        print(VERSION)
+        return 0
+    url = argv[0] if argv else 'BV1xx411c7mD'
+    work_dir = argv[argv.index('--work-dir') + 1] if '--work-dir' in argv else os.getcwd()
+    parts = env_number('FAKE_BBDOWN_PARTS', 1, int)
+    lines = env_number('FAKE_BBDOWN_PROGRESS_LINES', 2000, int)
+    interval = env_number('FAKE_BBDOWN_LINE_INTERVAL', 0.001)
+    debug_every = env_number('FAKE_BBDOWN_DEBUG_EVERY', 50, int)
+    file_size = env_number('FAKE_BBDOWN_FILE_SIZE', 1048576, int)
+    mux_seconds = env_number('FAKE_BBDOWN_MUX_SECONDS', 0.2)
+    fail_rate = env_number('FAKE_BBDOWN_FAIL_RATE', 0)
+    name = ''.join(c if c.isalnum() else '_' for c in url)[-40:]
+
+    print(f'BBDown version {VERSION}, Bilibili Downloader.')
+    log('获取aid...')
+    time.sleep(0.05)
+    log('获取aid结束: 170001')
+    log('获取视频信息...')
+    log(f'视频标题: 基准测试视频 {name}')
+    log('发布时间: 2024-01-01 12:00:00 +08:00')
+    log(f'共计 {parts} 个分P, 已选择：ALL')
+    if '--only-show-info' in argv:
+        for part in range(1, parts + 1):
+            log(f'P{part}: [{170000 + part}] [第{part}集] [05m30s]')
+        return 0
+
+    if random.random() < fail_rate:
+        log('ERROR: 412 Precondition Failed')
+        return 1
+    for part in range(1, parts + 1):
+        log(f'开始解析P{part}... ({part} of {parts})')
+        log('获取视频流...')
+        log('共计 3 条视频流.')
+        log('[DEBUG] Video: 1080P 高清 [1920x1080, avc1.640032, 3000 kbps]')
+        download_stream(part, '视频', lines, interval, debug_every, file_size)
+        download_stream(part, '音频', max(lines // 4, 1), interval, debug_every, file_size // 8)
+        log('开始合并音视频...')
+        time.sleep(mux_seconds)
+        os.makedirs(work_dir, exist_ok=True)
+        write_dummy_file(os.path.join(work_dir, f'{name}_P{part}.mp4'), file_size)
+        log('清理临时文件...')
+    log('任务完成')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""并发轮询压测：模拟多个页面同时轮询状态接口，统计请求延迟
+
+默认在临时数据目录中启动一个服务器进程（waitress，或加--dev使用Flask开发服务器），
+也可以用--url指向已经在运行的服务。--sse指定同时保持事件流（/api/events）的页面数，
+事件流在连接期间一直占用服务器线程，用来检查打开的页面很多时普通请求是否还能及时响应。
+
+用法:
+    python benchmarks/load_test.py [--clients 100] [--sse 40] [--duration 10] [--dev]
+    python benchmarks/load_test.py --url http://127.0.0.1:5555
+"""
+import argparse
+import collections
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(dev, threads):
+    """在临时数据目录中启动服务器，返回(进程, 地址)"""
+    port = free_port()
+    home = tempfile.mkdtemp(prefix='bbdown-web-load-')
+    env = dict(os.environ, HOME=home, BBDOWN_WEB_DATA_DIR=os.path.join(home, 'data'))
+    cmd = [sys.executable, os.path.join(ROOT, 'bbdown_web.py'), '--host', '127.0.0.1',
+           '--port', str(port), '--threads', str(threads)]
+    if dev:
+        cmd.append('--dev')
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('服务器启动超时')
+
+
+def poller(url, path, interval, stop, latencies, errors):
+    """一个客户端：保持keep-alive连接，按interval间隔轮询"""
+    parts = urllib.parse.urlsplit(url)
+    conn = None
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            else:
+                latencies.append(time.perf_counter() - start)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            if conn:
+                conn.close()
+            conn = None
+        if interval:
+            stop.wait(interval)
+    if conn:
+        conn.close()
+
+
+def sse_client(url, path, stop, stats, sockets):
+    """一个保持事件流的页面：被拒绝（503）时记录并在1秒后重试，连接结束后像EventSource一样重连
+
+    读取时一直阻塞，结束时由主线程关闭sockets中的连接。
+    """
+    parts = urllib.parse.urlsplit(url)
+    while not stop.is_set():
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+        sock = None
+        try:
+            conn.request('GET', path, headers={'Accept': 'text/event-stream'})
+            # 响应带Connection: close时getresponse()之后conn.sock为None，先取出socket
+            sock = conn.sock
+            response = conn.getresponse()
+            if response.status != 200:
+                response.read()
+                stats['rejected'] += 1
+                stop.wait(1)
+                continue
+            stats['connected'] += 1
+            sock.settimeout(None)
+            sockets.add(sock)
+            for line in response:
+                if line.startswith(b'event:'):
+                    stats['events'] += 1
+        except (OSError, http.client.HTTPException, ValueError):
+            if not stop.is_set():
+                stats['errors'] += 1
+                stop.wait(1)
+        finally:
+            sockets.discard(sock)
+            conn.close()
+
+
+def percentile(values, pct):
+    index = min(int(len(values) * pct / 100), len(values) - 1)
+    return values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='已运行服务的地址，不指定则自动启动一个')
+    parser.add_argument('--dev', action='store_true', help='自动启动时使用Flask开发服务器')
+    parser.add_argument('--threads', type=int, default=32, help='自动启动的服务器线程数')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=0, help='每个客户端两次请求的间隔（秒），0为不间断')
+    parser.add_argument('--path', default='/api/status')
+    parser.add_argument('--sse', type=int, default=0, help='同时保持事件流的客户端数')
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server(args.dev, args.threads)
+    try:
+        latencies, errors = [], []
+        sse_stats = collections.Counter()
+        stop = threading.Event()
+        # 先打开事件流，再开始轮询
+        sse_sockets = set()
+        sse_threads = [threading.Thread(target=sse_client, args=(url, '/api/events', stop, sse_stats, sse_sockets),
+                                        daemon=True)
+                       for _ in range(args.sse)]
+        for thread in sse_threads:
+            thread.start()
+        if sse_threads:
+            time.sleep(1)
+        threads = sse_threads + [
+            threading.Thread(target=poller, args=(url, args.path, args.interval, stop, latencies, errors),
+                             daemon=True) for _ in range(args.clients)]
+        started = time.perf_counter()
+        for thread in threads[len(sse_threads):]:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for sock in list(sse_sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in threads:
+            thread.join(15)
+        elapsed = time.perf_counter() - started
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    latencies.sort()
+    print(f"服务器: {url}{' (Flask开发服务器)' if args.dev and not args.url else ''}")
+    print(f"客户端: {args.clients}  时长: {args.duration:.0f}s  路径: {args.path}")
+    print(f"请求数: {len(latencies)}  失败: {len(errors)}  吞吐: {len(latencies) / elapsed:,.0f} 请求/秒")
+    if args.sse:
+        print(f"事件流: {args.sse} 个客户端  已连接: {sse_stats['connected']}  被拒绝(503): {sse_stats['rejected']}  "
+              f"收到事件: {sse_stats['events']}  连接错误: {sse_stats['errors']}")
+    if latencies:
+        print("延迟(ms): " + '  '.join(f"p{pct}={percentile(latencies, pct) * 1000:.1f}"
+                                      for pct in (50, 90, 99)) + f"  max={latencies[-1] * 1000:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""merge_move_tree测试：下载完成后移动文件时不能覆盖或丢失任何一方
+
+用法:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BBDOWN_WEB_DATA_DIR', tempfile.mkdtemp(prefix='bbdown-web-test-'))
+
+import bbdown_web as bw  # noqa: E402
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class MergeMoveTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dst = tempfile.mkdtemp()
+        self.messages = []
+
+    def merge(self):
+        bw.merge_move_tree(self.src, self.dst, self.messages.append)
+
+    def test_identical_file_keeps_original(self):
+        write(os.path.join(self.dst, 'a.mp4'), b'same')
+        write(os.path.join(self.src, 'a.mp4'), b'same')
+        self.merge()
+        self.assertEqual(os.listdir(self.dst), ['a.mp4'])
+        self.assertEqual(len(self.messages), 1)
+
+    def test_same_size_different_content_keeps_both(self):
+        write(os.path.join(self.dst, 'a.mp4'), b'old!')
+        write(os.path.join(self.src, 'a.mp4'), b'new!')
+        self.merge()
+        self.assertEqual(read(os.path.join(self.dst, 'a.mp4')), b'old!')
+        self.assertEqual(read(os.path.join(self.dst, 'a (1).mp4')), b'new!')
+
+    def test_nested_directories_are_merged(self):
+        write(os.path.join(self.dst, 'show', 'P1.mp4'), b'one')
+        write(os.path.join(self.dst, 'show', 'P1 (1).mp4'), b'x')
+        write(os.path.join(self.src, 'show', 'P1.mp4'), b'two')
+        write(os.path.join(self.src, 'show', 'P2.mp4'), b'p2')
+        self.merge()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dst, 'show'))),
+                         ['P1 (1).mp4', 'P1 (2).mp4', 'P1.mp4', 'P2.mp4'])
+        self.assertEqual(read(os.path.join(self.dst, 'show', 'P1 (2).mp4')), b'two')
+        self.assertEqual(os.listdir(self.src), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""parse_bbdown_info测试：把BBDown --only-show-info的输出整理成结构化数据
+
+用法:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BBDOWN_WEB_DATA_DIR', tempfile.mkdtemp(prefix='bbdown-web-test-'))
+
+import bbdown_web as bw  # noqa: E402
+
+INFO_OUTPUT = '''BBDown version 1.6.3, Bilibili Downloader.
+[2024-01-01 12:00:00.000] - 获取aid...
+[2024-01-01 12:00:00.000] - 获取aid结束: 170001
+[2024-01-01 12:00:00.000] - 获取视频信息...
+[2024-01-01 12:00:00.000] - 视频标题: 【MV】保加利亚妖王AZIS视频合辑
+[2024-01-01 12:00:00.000] - 发布时间: 2012-02-12 12:00:00 +08:00
+[2024-01-01 12:00:00.000] - P1: [279786] [Хоп] [04m05s]
+[2024-01-01 12:00:00.000] - P2: [279787] [Мразиш] [01h02m03s]
+[2024-01-01 12:00:00.000] - 共计 2 个分P, 已选择：ALL
+[2024-01-01 12:00:00.000] - 共计 2 条视频流.
+[2024-01-01 12:00:00.000] - 0. [1080P 高清] [1920x1080] [AVC] [30] [2000 kbps] [~80.5 MB]
+[2024-01-01 12:00:00.000] - 1. [720P 高清] [1280x720] [AVC] [30] [1000 kbps] [~40.2 MB]
+[2024-01-01 12:00:00.000] - 共计 1 条音频流.
+[2024-01-01 12:00:00.000] - 0. [M4A] [128 kbps] [~5.1 MB]
+'''
+
+
+class ParseBBDownInfoTest(unittest.TestCase):
+    def test_bv_input(self):
+        video = bw.parse_bbdown_info(INFO_OUTPUT, 'https://www.bilibili.com/video/BV17x411w7KC?p=2')
+        self.assertEqual(video['bvid'], 'BV17x411w7KC')
+        self.assertEqual(video['aid'], '170001')
+        self.assertEqual(video['title'], '【MV】保加利亚妖王AZIS视频合辑')
+        self.assertEqual([page['duration_seconds'] for page in video['pages']], [245, 3723])
+        self.assertEqual(video['video_streams'][0]['resolution'], '1920x1080')
+        self.assertEqual(video['video_streams'][1]['bitrate_kbps'], 1000)
+        self.assertEqual(video['audio_streams'][0]['codec'], 'M4A')
+
+    def test_av_input_gets_bvid(self):
+        video = bw.parse_bbdown_info(INFO_OUTPUT, 'av170001')
+        self.assertEqual(video['bvid'], 'BV17x411w7KC')
+        self.assertEqual(video['id'], 'BV17x411w7KC')
+        self.assertEqual(video['aid'], '170001')
+
+    def test_av_input_without_aid_line(self):
+        output = '\n'.join(line for line in INFO_OUTPUT.splitlines() if '获取aid结束' not in line)
+        video = bw.parse_bbdown_info(output, 'https://www.bilibili.com/video/av170001/')
+        self.assertEqual(video['aid'], '170001')
+        self.assertEqual(video['bvid'], 'BV17x411w7KC')
+
+    def test_episode_input_gets_bvid_from_aid(self):
+        video = bw.parse_bbdown_info(INFO_OUTPUT, 'https://www.bilibili.com/bangumi/play/ep123')
+        self.assertEqual(video['id'], 'ep123')
+        self.assertEqual(video['bvid'], 'BV17x411w7KC')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""短链接展开测试：用本地http.server代替b23.tv，返回302、200或超时
+
+用法:
+    python -m unittest discover -s tests
+"""
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HOME = tempfile.mkdtemp(prefix='bbdown-web-test-')
+os.environ['HOME'] = HOME
+os.environ['BBDOWN_WEB_DATA_DIR'] = os.path.join(HOME, 'data')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bbdown_web as bw  # noqa: E402
+
+TARGET = 'https://www.bilibili.com/video/BV17x411w7KC?share_source=copy'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """/ok: 302到完整地址  /relative: 302到相对地址  /plain: 200不跳转  /slow: 超时"""
+    hits = {}
+
+    def do_GET(self):
+        code = self.path.rsplit('/', 1)[-1]
+        StandInHandler.hits[code] = StandInHandler.hits.get(code, 0) + 1
+        if code.startswith('ok'):
+            self.send_response(302)
+            self.send_header('Location', TARGET)
+        elif code == 'relative':
+            self.send_response(302)
+            self.send_header('Location', '/video/BV1xx411c7mD')
+        elif code == 'slow':
+            time.sleep(1)
+            self.send_response(302)
+            self.send_header('Location', TARGET)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ShortLinkResolverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        bw.init_task_store(os.path.join(HOME, 'data', 'test.db'))
+        cls.timeout = bw.SHORT_LINK_TIMEOUT
+        bw.SHORT_LINK_TIMEOUT = 0.3
+
+    @classmethod
+    def tearDownClass(cls):
+        bw.SHORT_LINK_TIMEOUT = cls.timeout
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInHandler.hits.clear()
+        self.resolver = bw.ShortLinkResolver(self.base)
+
+    def hits(self, code):
+        return StandInHandler.hits.get(code, 0)
+
+    def test_expands_redirect_once(self):
+        self.assertEqual(self.resolver.resolve('https://b23.tv/ok1'), TARGET)
+        self.assertEqual(self.resolver.resolve('b23.tv/ok1'), TARGET)
+        self.assertEqual(self.hits('ok1'), 1)
+
+    def test_relative_location_is_joined_with_base(self):
+        self.assertEqual(self.resolver.resolve('https://b23.tv/relative'), self.base + '/video/BV1xx411c7mD')
+
+    def test_other_urls_are_unchanged(self):
+        url = 'https://www.bilibili.com/video/BV1xx411c7mD'
+        self.assertEqual(self.resolver.resolve(url), url)
+        self.assertEqual(StandInHandler.hits, {})
+
+    def test_sqlite_cache_survives_new_resolver(self):
+        self.resolver.resolve('https://b23.tv/ok2')
+        bw.task_store.flush()
+        fresh = bw.ShortLinkResolver(self.base)
+        self.assertEqual(fresh.resolve('https://b23.tv/ok2'), TARGET)
+        self.assertEqual(self.hits('ok2'), 1)
+
+    def test_expired_memory_entry_falls_back_to_sqlite(self):
+        self.resolver.resolve('https://b23.tv/ok3')
+        bw.task_store.flush()
+        self.resolver.cache['ok3'] = (TARGET, time.time() - 1)
+        self.assertEqual(self.resolver.resolve('https://b23.tv/ok3'), TARGET)
+        self.assertEqual(self.hits('ok3'), 1)
+
+    def test_expired_sqlite_entry_is_looked_up_again(self):
+        self.resolver.resolve('https://b23.tv/ok4')
+        bw.task_store.flush()
+        with bw.task_store.db_lock:
+            bw.task_store.conn.execute('UPDATE short_links SET resolved_at = ? WHERE code = ?',
+                                       (time.time() - bw.SHORT_LINK_TTL - 1, 'ok4'))
+            bw.task_store.conn.commit()
+        fresh = bw.ShortLinkResolver(self.base)
+        self.assertEqual(fresh.resolve('https://b23.tv/ok4'), TARGET)
+        self.assertEqual(self.hits('ok4'), 2)
+
+    def test_no_redirect_falls_back_and_is_cached_briefly(self):
+        url = 'https://b23.tv/plain'
+        self.assertEqual(self.resolver.resolve(url), url)
+        self.assertEqual(self.resolver.resolve(url), url)
+        self.assertEqual(self.hits('plain'), 1)
+        # 失败结果只缓存在内存中，过期后重新请求
+        self.assertGreater(self.resolver.cache['plain'][1], time.time() + bw.SHORT_LINK_FAILURE_TTL - 5)
+        bw.task_store.flush()
+        self.assertIsNone(bw.task_store.load_short_link('plain', 0))
+        self.resolver.cache['plain'] = (None, time.time() - 1)
+        self.resolver.resolve(url)
+        self.assertEqual(self.hits('plain'), 2)
+
+    def test_timeout_falls_back_to_original_link(self):
+        url = 'https://b23.tv/slow'
+        start = time.time()
+        self.assertEqual(self.resolver.resolve(url), url)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.resolver.resolve(url), url)
+        self.assertEqual(self.hits('slow'), 1)
+
+    def test_unreachable_server_falls_back(self):
+        resolver = bw.ShortLinkResolver('http://127.0.0.1:9')
+        self.assertEqual(resolver.resolve('https://b23.tv/ok5'), 'https://b23.tv/ok5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""下载线程测试：用临时生成的模拟BBDown运行任务，不需要网络
+
+用法:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+HOME = tempfile.mkdtemp(prefix='bbdown-web-test-')
+os.environ['HOME'] = HOME
+os.environ['BBDOWN_WEB_DATA_DIR'] = os.path.join(HOME, 'data')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bbdown_web as bw  # noqa: E402
+
+# 输出几行日志后长时间运行的模拟BBDown
+FAKE_BBDOWN = '''#!{python}
+import sys, time
+print('[2024-01-01 12:00:00.000] - 获取aid...', flush=True)
+for i in range(600):
+    print('[2024-01-01 12:00:00.000] - 开始下载P1视频...', flush=True)
+    time.sleep(0.1)
+'''
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class WorkerCrashTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = os.path.join(HOME, 'downloads')
+        bbdown = os.path.join(HOME, 'BBDown')
+        with open(bbdown, 'w') as f:
+            f.write(FAKE_BBDOWN.format(python=sys.executable))
+        os.chmod(bbdown, 0o755)
+        bw.init_task_store(os.path.join(HOME, 'data', 'test.db'))
+        bw.app_settings.update(bbdown_path=bbdown, default_dir=cls.work_dir)
+        bw.worker_pool.resize(1)
+
+    def setUp(self):
+        self.originals = (bw.match_stage, bw.start_download_process, bw.MAX_RESIDENT_TASKS)
+        self.processes = []
+
+        def start(cmd, cwd):
+            process = self.originals[1](cmd, cwd)
+            self.processes.append(process)
+            return process
+        bw.start_download_process = start
+
+    def tearDown(self):
+        bw.match_stage, bw.start_download_process, bw.MAX_RESIDENT_TASKS = self.originals
+
+    def test_exception_after_start_cleans_up_and_evicts_task(self):
+        def crash(line):
+            raise RuntimeError('模拟的内部错误')
+        bw.match_stage = crash
+        # 结束的任务不在内存中保留，立即转存到磁盘
+        bw.MAX_RESIDENT_TASKS = 0
+
+        task_id = bw.submit_downloads(['BV1xx411c7mD'], {'work_dir': self.work_dir}, force=True)[0][1]
+        stage_dir = bw.get_task_stage_dir(self.work_dir, task_id)
+
+        self.assertTrue(wait_for(lambda: task_id not in bw.download_status), '任务没有移出内存')
+        self.assertTrue(any(entry['task_id'] == task_id and entry['status'] == 'failed'
+                            for entry in bw.download_history))
+        meta, log = bw.load_spilled_log(task_id)
+        self.assertEqual(meta['status'], 'failed')
+        self.assertIn('模拟的内部错误', log.text())
+        self.assertIsNotNone(meta['timeline'][-1]['end'])
+        self.assertFalse(os.path.exists(stage_dir))
+        self.assertEqual(len(self.processes), 1)
+        self.assertTrue(wait_for(lambda: not pid_alive(self.processes[0].pid)), 'BBDown进程没有结束')
+        self.assertNotIn(bw.download_key('BV1xx411c7mD', {'work_dir': self.work_dir}), bw.active_downloads)
+
+
+if __name__ == '__main__':
+    unittest.main()